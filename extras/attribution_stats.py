@@ -0,0 +1,118 @@
+"""
+Streaming statistics of attribution maps per (source class, target class).
+
+Attribution batches are folded into running means and variances as they are
+produced (Welford's algorithm, in the batched form of Chan et al.), so the
+full set of maps never needs to be kept in memory. Aggregators built by
+parallel workers can be merged, and the result is saved as a small `.npz`.
+"""
+
+import numpy as np
+import torch
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+class AttributionAggregator:
+    """
+    Running mean, variance and per-channel sums of attribution maps, kept
+    separately for every (source class, target class) pair.
+    """
+
+    def __init__(self, num_classes=4, shape=(3, 28, 28)):
+        self.num_classes = num_classes
+        self.shape = tuple(shape)
+        pairs = (num_classes, num_classes)
+        self.count = np.zeros(pairs, dtype=np.int64)
+        self.mean = np.zeros(pairs + self.shape)
+        self.m2 = np.zeros(pairs + self.shape)
+        self.channel_sum = np.zeros(pairs + self.shape[:1])
+        self.channel_abs_sum = np.zeros(pairs + self.shape[:1])
+
+    def update(self, attributions, source, target):
+        """
+        Add a batch of attribution maps of shape `(B, *shape)`, with the
+        source and target class of each. `target` may be a single class.
+        """
+        attributions = _to_numpy(attributions).astype(np.float64)
+        source = np.broadcast_to(_to_numpy(source), len(attributions))
+        target = np.broadcast_to(_to_numpy(target), len(attributions))
+        pair = source * self.num_classes + target
+        num_pairs = self.num_classes**2
+
+        # Statistics of the batch, per pair
+        count = np.bincount(pair, minlength=num_pairs)
+        total = np.zeros((num_pairs,) + self.shape)
+        np.add.at(total, pair, attributions)
+        mean = total / np.maximum(count, 1).reshape(-1, *[1] * len(self.shape))
+        m2 = np.zeros_like(total)
+        np.add.at(m2, pair, (attributions - mean[pair]) ** 2)
+        channel_axes = tuple(range(2, attributions.ndim))
+        channel_sum = np.zeros((num_pairs, self.shape[0]))
+        np.add.at(channel_sum, pair, attributions.sum(axis=channel_axes))
+        channel_abs_sum = np.zeros((num_pairs, self.shape[0]))
+        np.add.at(
+            channel_abs_sum, pair, np.abs(attributions).sum(axis=channel_axes)
+        )
+
+        pairs = (self.num_classes, self.num_classes)
+        self._combine(
+            count.reshape(pairs),
+            mean.reshape(pairs + self.shape),
+            m2.reshape(pairs + self.shape),
+            channel_sum.reshape(pairs + self.shape[:1]),
+            channel_abs_sum.reshape(pairs + self.shape[:1]),
+        )
+
+    def merge(self, other):
+        """Fold the statistics of another aggregator into this one"""
+        self._combine(
+            other.count, other.mean, other.m2, other.channel_sum, other.channel_abs_sum
+        )
+        return self
+
+    def _combine(self, count, mean, m2, channel_sum, channel_abs_sum):
+        expand = (...,) + (None,) * len(self.shape)
+        total = self.count + count
+        weight = np.divide(count, total, out=np.zeros(total.shape), where=total > 0)
+        delta = mean - self.mean
+        self.m2 += m2 + delta**2 * (self.count * weight)[expand]
+        self.mean += delta * weight[expand]
+        self.count = total
+        self.channel_sum += channel_sum
+        self.channel_abs_sum += channel_abs_sum
+
+    @property
+    def variance(self):
+        """Sample variance of each pixel, NaN for pairs with fewer than 2 maps"""
+        expand = (...,) + (None,) * len(self.shape)
+        denominator = (self.count - 1)[expand].astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(denominator > 0, self.m2 / denominator, np.nan)
+
+    def save(self, path):
+        """Write the summary as a compressed `.npz` file"""
+        np.savez_compressed(
+            path,
+            count=self.count,
+            mean=self.mean,
+            m2=self.m2,
+            channel_sum=self.channel_sum,
+            channel_abs_sum=self.channel_abs_sum,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as summary:
+            count = summary["count"]
+            aggregator = cls(num_classes=len(count), shape=summary["mean"].shape[2:])
+            aggregator.count = count
+            aggregator.mean = summary["mean"]
+            aggregator.m2 = summary["m2"]
+            aggregator.channel_sum = summary["channel_sum"]
+            aggregator.channel_abs_sum = summary["channel_abs_sum"]
+        return aggregator
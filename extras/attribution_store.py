@@ -0,0 +1,320 @@
+"""
+On-disk store of attribution maps, indexed by (image index, baseline, target
+class).
+
+Every (baseline, target class) pair is one array of maps, split into chunks
+of `chunk_size` consecutive images. A chunk is stored as float16, with the
+high and low bytes of all values grouped together (which makes them far more
+compressible), compressed with zlib. Chunks are concatenated in a `.bin`
+file, and a `.npy` of offsets locates each one, so reading a single map
+decompresses a single chunk, and recently used chunks are kept in an LRU
+cache. Scanning an array reads the file front to back.
+
+`write_store` computes the attributions of a split in dataset order, so the
+image index is the index in the split, and streams them batch by batch into
+the store. It takes the options of `pipeline.py`, except that `--baselines`
+and `--target-classes` replace `--baseline` and `--target-class`, and that
+the whole split is used unless `--num-images` is given.
+
+    python attribution_store.py attributions_store \\
+        --baselines zeros counterfactual --target-classes 0 1 2 3
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+import argparse
+import json
+import numpy as np
+import os
+import torch
+import zlib
+
+
+# Only these baselines depend on the target class, the others are stored once
+TARGETED_BASELINES = ("counterfactual",)
+
+
+def _array_name(baseline, target):
+    if baseline in TARGETED_BASELINES:
+        return f"{baseline}_{int(target)}"
+    return baseline
+
+
+def encode_chunk(maps, level=1):
+    """Compress float maps as byte-shuffled float16"""
+    raw = np.ascontiguousarray(maps, dtype=np.float16).view(np.uint8)
+    return zlib.compress(raw.reshape(-1, 2).T.tobytes(), level)
+
+
+def decode_chunk(data, shape):
+    """Inverse of `encode_chunk`, returns float32 maps of shape `(-1, *shape)`"""
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+    raw = np.ascontiguousarray(shuffled.reshape(2, -1).T)
+    return raw.view(np.float16).astype(np.float32).reshape(-1, *shape)
+
+
+class AttributionStoreWriter:
+    """
+    Write attribution maps to a store. Maps of each (baseline, target) pair
+    are added in image order; chunks are compressed and written as soon as
+    they are full, so only one chunk per pair is held in memory.
+    """
+
+    def __init__(self, path, shape=(3, 28, 28), chunk_size=256, metadata=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Rewriting a store: remove the index first, so that a crash can't
+        # leave it pointing into truncated data
+        (self.path / "index.json").unlink(missing_ok=True)
+        for stale in self.path.glob("*.offsets.npy"):
+            stale.unlink()
+        self.shape = tuple(shape)
+        self.chunk_size = chunk_size
+        self.metadata = metadata or {}
+        self._files = {}
+        self._offsets = {}
+        self._buffers = {}
+        self._counts = {}
+
+    def add(self, baseline, target, attributions):
+        """
+        Append a batch of maps of shape `(B, *shape)` to `(baseline, target)`.
+        `target` is ignored for baselines that don't depend on it.
+        """
+        if torch.is_tensor(attributions):
+            attributions = attributions.detach().cpu().numpy()
+        name = _array_name(baseline, target)
+        if name not in self._files:
+            self._files[name] = open(self.path / f"{name}.bin", "wb")
+            self._offsets[name] = [0]
+            self._buffers[name] = []
+            self._counts[name] = 0
+        self._buffers[name].append(np.asarray(attributions))
+        self._counts[name] += len(attributions)
+        buffered = np.concatenate(self._buffers[name])
+        full = len(buffered) - len(buffered) % self.chunk_size
+        for start in range(0, full, self.chunk_size):
+            self._write_chunk(name, buffered[start : start + self.chunk_size])
+        self._buffers[name] = [buffered[full:]]
+
+    def _write_chunk(self, name, maps):
+        data = encode_chunk(maps)
+        self._files[name].write(data)
+        self._offsets[name].append(self._offsets[name][-1] + len(data))
+
+    def close(self):
+        """Write the partial last chunks, the offsets and the index"""
+        arrays = {}
+        for name, f in self._files.items():
+            buffered = np.concatenate(self._buffers[name])
+            if len(buffered) > 0:
+                self._write_chunk(name, buffered)
+            f.close()
+            np.save(self.path / f"{name}.offsets.npy", np.array(self._offsets[name]))
+            arrays[name] = self._counts[name]
+        # The index is written last, a store without one is incomplete
+        tmp_path = self.path / "index.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "shape": self.shape,
+                    "chunk_size": self.chunk_size,
+                    "arrays": arrays,
+                    "metadata": self.metadata,
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp_path, self.path / "index.json")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the store without an index, so it isn't mistaken as complete
+            for f in self._files.values():
+                f.close()
+
+
+class AttributionStore:
+    """
+    Read maps from a store. `store[index, baseline, target]` is a single
+    float32 map; the `cache_size` most recently used chunks stay decompressed.
+    The target is ignored for baselines that don't depend on it.
+    """
+
+    def __init__(self, path, cache_size=64):
+        self.path = Path(path)
+        with open(self.path / "index.json", "r") as f:
+            index = json.load(f)
+        self.shape = tuple(index["shape"])
+        self.chunk_size = index["chunk_size"]
+        self.arrays = index["arrays"]
+        self.metadata = index.get("metadata", {})
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._data = {}
+        self._offsets = {}
+
+    def keys(self):
+        """The (baseline, target) pairs in the store, target None if unused"""
+        pairs = [name.partition("_")[::2] for name in self.arrays]
+        return [
+            (baseline, int(target) if target else None) for baseline, target in pairs
+        ]
+
+    def __len__(self):
+        return sum(self.arrays.values())
+
+    def num_images(self, baseline, target):
+        return self.arrays[_array_name(baseline, target)]
+
+    def _open(self, name):
+        if name not in self._data:
+            data_path = self.path / f"{name}.bin"
+            if data_path.stat().st_size == 0:
+                # An array without maps, which can't be memory-mapped
+                self._data[name] = np.empty(0, dtype=np.uint8)
+            else:
+                self._data[name] = np.memmap(data_path, mode="r")
+            self._offsets[name] = np.load(self.path / f"{name}.offsets.npy")
+        return self._data[name], self._offsets[name]
+
+    def _read_chunk(self, name, chunk):
+        data, offsets = self._open(name)
+        return decode_chunk(data[offsets[chunk] : offsets[chunk + 1]], self.shape)
+
+    def chunk(self, baseline, target, chunk):
+        """The decompressed maps of one chunk, through the LRU cache"""
+        key = (_array_name(baseline, target), chunk)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        maps = self._read_chunk(*key)
+        self._cache[key] = maps
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return maps
+
+    def __getitem__(self, key):
+        index, baseline, target = key
+        chunk, offset = divmod(index, self.chunk_size)
+        return self.chunk(baseline, target, chunk)[offset]
+
+    def read(self, baseline, target, indices):
+        """The maps at `indices`, of shape `(len(indices), *shape)`"""
+        indices = np.asarray(indices)
+        chunks, offsets = np.divmod(indices, self.chunk_size)
+        result = np.empty((len(indices),) + self.shape, dtype=np.float32)
+        for chunk in np.unique(chunks):
+            mask = chunks == chunk
+            result[mask] = self.chunk(baseline, target, chunk)[offsets[mask]]
+        return result
+
+    def scan(self, baseline, target):
+        """Yield the maps of `(baseline, target)` chunk by chunk, in order"""
+        name = _array_name(baseline, target)
+        num_chunks = len(self._open(name)[1]) - 1
+        for chunk in range(num_chunks):
+            # Bypass the cache, a scan would only evict the useful chunks
+            yield self._read_chunk(name, chunk)
+
+
+def write_store(
+    path,
+    config,
+    baselines,
+    target_classes,
+    data_dir="../data",
+    device=None,
+    batch_size=64,
+    chunk_size=256,
+):
+    """
+    Compute the attributions of the first `config["num_images"]` images of
+    `config["split"]` (all of them if None), in order, for every baseline and
+    target class, and write them to the store at `path` one batch at a time.
+    `config` holds the options of `pipeline.py`.
+    """
+    from data_pipeline import make_dataloader, prefetch
+    from gan_metrics import class_prototypes, load_classifier
+    from pipeline import attribute_batch, counterfactual_translator, make_baselines
+    from torch.utils.data import Subset
+    from tqdm import tqdm
+    from utils import load_split
+
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = load_split(data_dir, config["split"])
+    if config["num_images"] is not None:
+        dataset = Subset(dataset, range(min(config["num_images"], len(dataset))))
+    model = load_classifier(config["classifier_checkpoint"], device=device)
+    translate = None
+    if "counterfactual" in baselines:
+        prototypes = class_prototypes(load_split(data_dir, "test")).to(device)
+        translate = counterfactual_translator(
+            config["counterfactual_method"],
+            model,
+            prototypes,
+            generator_checkpoint=config["generator_checkpoint"],
+            size_style=config["size_style"],
+            depth=config["depth"],
+            device=device,
+        )
+    random_generator = torch.Generator().manual_seed(config["seed"])
+    dataloader = make_dataloader(dataset, batch_size=batch_size, device=device)
+    metadata = {"split": config["split"], "num_images": len(dataset)}
+    with AttributionStoreWriter(
+        path, chunk_size=chunk_size, metadata=metadata
+    ) as writer:
+        for x, y in tqdm(prefetch(dataloader, device), desc="Attributions"):
+            # The counterfactuals of all targets are translated at once
+            x_fake = translate(x) if translate is not None else None
+            for baseline in baselines:
+                targets = [None]
+                if baseline in TARGETED_BASELINES:
+                    targets = target_classes
+                for target in targets:
+                    counterfactual = None if target is None else x_fake[:, target]
+                    attributions, _ = attribute_batch(
+                        model,
+                        x,
+                        y,
+                        make_baselines(x, baseline, random_generator, counterfactual),
+                        config["ig_tolerance"],
+                    )
+                    writer.add(baseline, target, attributions)
+
+
+if __name__ == "__main__":
+    from pipeline_args import add_pipeline_arguments
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store")
+    parser.add_argument(
+        "--baselines",
+        nargs="+",
+        default=["counterfactual"],
+        choices=["zeros", "random", "blurred", "counterfactual"],
+    )
+    parser.add_argument("--target-classes", type=int, nargs="+", default=[0])
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=64)
+    add_pipeline_arguments(parser)
+    parser.set_defaults(num_images=None)
+    args = parser.parse_args()
+
+    write_store(
+        args.store,
+        vars(args),
+        args.baselines,
+        args.target_classes,
+        data_dir=args.data_dir,
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size,
+    )
+    sizes = [f.stat().st_size for f in Path(args.store).glob("*.bin")]
+    print(f"Stored {len(AttributionStore(args.store))} maps in {sum(sizes)} bytes")
@@ -0,0 +1,255 @@
+"""
+Find the fastest CPU thread settings and batch size for this machine.
+
+The `DenseModel` classifier, the `Generator` and integrated gradients
+attribution are benchmarked for every combination of candidate intra-op
+threads, inter-op threads and batch sizes. Inter-op threads can only be set
+once per process, so each inter-op setting is benchmarked in its own process.
+The best configuration is cached in `autotune.json`, per host and workload
+signature, which includes the model configuration (e.g. the generator's
+depth), so the benchmark only runs once per machine and model. Processes starting
+at the same time take turns through a lock file, so their benchmarks don't
+compete for the cores and only the first one runs.
+
+    python autotune.py dense_model generator integrated_gradients
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from utils import available_cores
+
+CACHE_PATH = Path(__file__).parent / "autotune.json"
+BATCH_SIZES = {
+    "dense_model": (32, 64, 128, 256, 512, 1024),
+    "generator": (16, 32, 64, 128, 256),
+    "integrated_gradients": (1, 4, 8, 16, 32),
+}
+# The model configuration of each workload, unless the caller overrides it
+MODELS = {
+    "dense_model": {"num_classes": 4},
+    "generator": {"depth": 2, "size_style": 8},
+    "integrated_gradients": {"num_classes": 4},
+}
+
+
+def candidate_threads():
+    """Powers of two up to the number of available cores, and that number"""
+    cores = len(available_cores())
+    candidates = {cores}
+    n = 1
+    while n < cores:
+        candidates.add(n)
+        n *= 2
+    return sorted(candidates)
+
+
+def model_config(workload, **overrides):
+    """The model configuration of `workload`, with `overrides` applied"""
+    if workload not in MODELS:
+        raise ValueError(f"Unknown workload {workload}")
+    unknown = set(overrides) - set(MODELS[workload])
+    if unknown:
+        raise ValueError(f"Unknown {workload} options {', '.join(sorted(unknown))}")
+    return {**MODELS[workload], **overrides}
+
+
+def signature(workload, model):
+    """
+    Identifies a workload and its `model` configuration together with the
+    software and hardware it ran on
+    """
+    import torch
+    options = "-".join(f"{key}{value}" for key, value in sorted(model.items()))
+    return (
+        f"{workload}-{options}-torch{torch.__version__}"
+        f"-{len(available_cores())}cores"
+    )
+
+
+def _build(workload, model):
+    """A function running `workload` on a batch, weights don't affect timing"""
+    import torch
+    from torch import nn
+    from classifier.model import DenseModel
+
+    if workload == "dense_model":
+        classifier = DenseModel(
+            input_shape=(3, 28, 28), num_classes=model["num_classes"]
+        ).eval()
+
+        def run(x):
+            with torch.inference_mode():
+                return classifier(x)
+
+    elif workload == "generator":
+        from dlmbl_unet import UNet
+        from train_gan import Generator
+
+        unet = UNet(
+            depth=model["depth"],
+            in_channels=3 + model["size_style"],
+            out_channels=3,
+            final_activation=nn.Sigmoid(),
+        )
+        style_mapping = DenseModel(
+            input_shape=(3, 28, 28), num_classes=model["size_style"]
+        )
+        generator = Generator(unet, style_mapping=style_mapping).eval()
+
+        def run(x):
+            with torch.inference_mode():
+                return generator(x, x)
+
+    elif workload == "integrated_gradients":
+        from captum.attr import IntegratedGradients
+
+        classifier = DenseModel(
+            input_shape=(3, 28, 28), num_classes=model["num_classes"]
+        ).eval()
+        integrated_gradients = IntegratedGradients(classifier)
+
+        def run(x):
+            return integrated_gradients.attribute(x, target=0)
+
+    else:
+        raise ValueError(f"Unknown workload {workload}")
+    return run
+
+
+def _sweep(workload, model, interop_threads, threads, batch_sizes, min_time):
+    """Throughput for every thread count and batch size, in this process"""
+    import torch
+
+    torch.set_num_interop_threads(interop_threads)
+    run = _build(workload, model)
+    results = []
+    for num_threads in threads:
+        torch.set_num_threads(num_threads)
+        for batch_size in batch_sizes:
+            x = torch.rand(batch_size, 3, 28, 28)
+            run(x)  # warm up
+            count = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < min_time:
+                run(x)
+                count += 1
+            throughput = count * batch_size / (time.perf_counter() - start)
+            results.append((num_threads, batch_size, throughput))
+    return results
+
+
+def autotune(workload, model=None, interop_candidates=(1, 2), min_time=0.2):
+    """Benchmark `workload` with its `model` and return the fastest configuration"""
+    model = model_config(workload, **(model or {}))
+    context = multiprocessing.get_context("spawn")
+    best = None
+    for interop_threads in interop_candidates:
+        with context.Pool(1) as pool:
+            results = pool.apply(
+                _sweep,
+                (
+                    workload,
+                    model,
+                    interop_threads,
+                    candidate_threads(),
+                    BATCH_SIZES[workload],
+                    min_time,
+                ),
+            )
+        for num_threads, batch_size, throughput in results:
+            if best is None or throughput > best["throughput"]:
+                best = {
+                    "num_threads": num_threads,
+                    "num_interop_threads": interop_threads,
+                    "batch_size": batch_size,
+                    "throughput": throughput,
+                }
+    return best
+
+
+@contextmanager
+def _file_lock(path):
+    """Hold an exclusive lock on the file at `path`, waiting for it if needed"""
+    with open(path, "a") as f:
+        try:
+            import fcntl
+        except ImportError:  # Windows
+            import msvcrt
+
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # Gave up after 10 seconds, keep waiting
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+def _read_cache(cache_path):
+    if not cache_path.exists():
+        return {}
+    with open(cache_path, "r") as f:
+        return json.load(f)
+
+
+def get_config(workload, cache_path=CACHE_PATH, apply=True, **model):
+    """
+    The cached configuration of `workload` on this host, benchmarking it first
+    if there is none. `model` overrides the model configuration in `MODELS`,
+    e.g. `depth` and `size_style` for the generator. With `apply`, the thread
+    settings are applied to this process (the inter-op setting only if no
+    parallel work has started yet).
+    """
+    cache_path = Path(cache_path)
+    model = model_config(workload, **model)
+    key = signature(workload, model)
+    cache = _read_cache(cache_path)
+    if key not in cache.get(platform.node(), {}):
+        with _file_lock(cache_path.with_suffix(".lock")):
+            # Another process may have tuned it while we waited for the lock
+            cache = _read_cache(cache_path)
+            host = cache.setdefault(platform.node(), {})
+            if key not in host:
+                print(f"Autotuning {workload}, this only happens once per machine")
+                host[key] = autotune(workload, model)
+                fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_path.parent)
+                with os.fdopen(fd, "w") as f:
+                    json.dump(cache, f, indent=2)
+                os.replace(tmp_path, cache_path)
+    config = cache[platform.node()][key]
+    if apply:
+        apply_config(config)
+    return config
+
+
+def apply_config(config):
+    import torch
+
+    torch.set_num_threads(config["num_threads"])
+    try:
+        torch.set_num_interop_threads(config["num_interop_threads"])
+    except RuntimeError:
+        pass  # Parallel work has already started in this process
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("workloads", nargs="+", choices=sorted(BATCH_SIZES))
+    args = parser.parse_args()
+    for workload in args.workloads:
+        print(workload, get_config(workload, apply=False))
@@ -0,0 +1,109 @@
+"""
+Measure peak memory and time per optimizer step of GAN training for different
+micro-batch sizes, gradient accumulation and activation checkpointing
+settings.
+
+Every setting runs in its own process so that peak memory is measured from a
+clean start: `torch.cuda.max_memory_allocated` on GPU, the maximum resident
+set size on CPU (which includes the interpreter and libraries).
+
+    python benchmark_gan_step.py --effective-batch-size 256
+"""
+
+from dlmbl_unet import UNet
+from classifier.model import DenseModel
+from train_gan import Generator, enable_activation_checkpointing, train_step
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+from torch import nn
+
+
+def _benchmark(batch_size, accumulation_steps, activation_checkpointing, num_steps):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    size_style = 8
+    unet = UNet(
+        depth=2,
+        in_channels=3 + size_style,
+        out_channels=3,
+        final_activation=nn.Sigmoid(),
+    )
+    if activation_checkpointing:
+        enable_activation_checkpointing(unet)
+    style_mapping = DenseModel(input_shape=(3, 28, 28), num_classes=size_style)
+    generator = Generator(unet, style_mapping=style_mapping).to(device)
+    discriminator = DenseModel(input_shape=(3, 28, 28), num_classes=4).to(device)
+    optimizer_g = torch.optim.Adam(generator.parameters(), lr=1e-4)
+    optimizer_d = torch.optim.Adam(discriminator.parameters(), lr=1e-6)
+    cycle_loss_fn = nn.L1Loss()
+    class_loss_fn = nn.CrossEntropyLoss()
+    x = torch.rand(batch_size, 3, 28, 28, device=device)
+    y = torch.randint(0, 4, (batch_size,), device=device)
+
+    def optimizer_step():
+        optimizer_g.zero_grad()
+        optimizer_d.zero_grad()
+        for _ in range(accumulation_steps):
+            train_step(
+                generator,
+                discriminator,
+                x,
+                y,
+                cycle_loss_fn,
+                class_loss_fn,
+                loss_scale=1 / accumulation_steps,
+            )
+        optimizer_g.step()
+        optimizer_d.step()
+
+    optimizer_step()  # warm up
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        optimizer_step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated()
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return (time.perf_counter() - start) / num_steps, peak_memory
+
+
+def benchmark(batch_size, accumulation_steps, activation_checkpointing, num_steps=10):
+    """Seconds per optimizer step and peak memory in bytes, in a fresh process"""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(
+            _benchmark,
+            (batch_size, accumulation_steps, activation_checkpointing, num_steps),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--effective-batch-size", type=int, default=256)
+    parser.add_argument(
+        "--micro-batch-sizes", type=int, nargs="+", default=[256, 64, 32]
+    )
+    parser.add_argument("--num-steps", type=int, default=10)
+    args = parser.parse_args()
+
+    print("micro batch | accumulation | checkpointing | s/step | peak memory (MB)")
+    for micro_batch_size in args.micro_batch_sizes:
+        accumulation_steps = args.effective_batch_size // micro_batch_size
+        for activation_checkpointing in (False, True):
+            step_time, peak_memory = benchmark(
+                micro_batch_size,
+                accumulation_steps,
+                activation_checkpointing,
+                num_steps=args.num_steps,
+            )
+            print(
+                f"{micro_batch_size:11d} | {accumulation_steps:12d} | "
+                f"{str(activation_checkpointing):>13} | {step_time:6.3f} | "
+                f"{peak_memory / 2**20:.0f}"
+            )
@@ -0,0 +1,82 @@
+"""
+Compare the wall-clock time the StarGAN needs to reach a target flip rate
+when starting cold and when the discriminator (and style mapping) are warm
+started from the classifier.
+
+Every setting trains from scratch in its own process and a temporary
+directory, and stops as soon as the flip rate reaches the target.
+
+    python benchmark_warm_start.py --target-flip-rate 0.8 --num-frozen 2
+"""
+
+from train_gan import train_gan
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import multiprocessing
+from pathlib import Path
+import tempfile
+
+SETTINGS = {
+    "cold": {},
+    "warm discriminator": {"warm_start_discriminator": True},
+    "warm discriminator + style": {
+        "warm_start_discriminator": True,
+        "warm_start_style": True,
+    },
+}
+
+
+def _time_to_target(target_flip_rate, kwargs):
+    with tempfile.TemporaryDirectory() as save_dir:
+        train_gan(save_dir=save_dir, target_flip_rate=target_flip_rate, **kwargs)
+        with open(Path(save_dir) / "flip_rate.json", "r") as f:
+            flip_rates = json.load(f)
+    for evaluation in flip_rates:
+        if evaluation["flip_rate"] >= target_flip_rate:
+            return evaluation
+    return None
+
+
+def time_to_target(target_flip_rate, **kwargs):
+    """
+    The first evaluation (step, epoch, flip rate and seconds) at which
+    `train_gan(**kwargs)` reaches `target_flip_rate`, or None if it never
+    does. Runs in a fresh process, which is not daemonic so that it can start
+    data loader workers.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_time_to_target, target_flip_rate, kwargs).result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target-flip-rate", type=float, default=0.8)
+    parser.add_argument("--total-epochs", type=int, default=14)
+    parser.add_argument("--eval-every", type=int, default=100)
+    parser.add_argument("--num-frozen", type=int, default=0)
+    parser.add_argument("--unfreeze-every", type=int, default=1)
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    args = parser.parse_args()
+
+    print("setting                    |   step | epoch | seconds")
+    for name, setting in SETTINGS.items():
+        result = time_to_target(
+            args.target_flip_rate,
+            data_dir=args.data_dir,
+            classifier_checkpoint=args.classifier_checkpoint,
+            total_epochs=args.total_epochs,
+            eval_every=args.eval_every,
+            num_frozen=args.num_frozen,
+            unfreeze_every=args.unfreeze_every,
+            **setting,
+        )
+        if result is None:
+            print(f"{name:26} | target not reached")
+        else:
+            print(
+                f"{name:26} | {result['step']:6d} | {result['epoch']:5d} | "
+                f"{result['seconds']:7.1f}"
+            )
@@ -0,0 +1,204 @@
+"""
+Single entry point for the scripts in this directory.
+
+Only `argparse` is imported up front: every subcommand imports the modules it
+needs (and with them torch, captum, ...) when it runs, so `--help` and typos
+return immediately. `check-startup` guards this by timing a cold start in a
+fresh interpreter.
+
+    python cli.py train-gan --total-epochs 20
+    python cli.py attribute --baseline counterfactual --target-class 2
+    python cli.py check-startup
+"""
+
+import argparse
+import sys
+from pipeline_args import add_pipeline_arguments
+
+# Modules that must not be imported before a subcommand runs
+HEAVY_MODULES = (
+    "torch",
+    "captum",
+    "sklearn",
+    "seaborn",
+    "matplotlib",
+    "dlmbl_unet",
+)
+
+
+def train_classifier(args):
+    from pathlib import Path
+    from train_classifier import train_classifier
+
+    train_classifier(
+        base_dir=args.base_dir or Path(__file__).parent,
+        epochs=args.epochs,
+        lr=args.lr,
+        data_dir=args.data_dir,
+        num_workers=args.num_workers,
+    )
+
+
+def train_gan(args):
+    from train_gan import train_gan
+
+    train_gan(
+        save_dir=args.save_dir,
+        data_dir=args.data_dir,
+        classifier_checkpoint=args.classifier_checkpoint,
+        size_style=args.size_style,
+        depth=args.depth,
+        batch_size=args.batch_size,
+        accumulation_steps=args.accumulation_steps,
+        activation_checkpointing=args.activation_checkpointing,
+        total_epochs=args.total_epochs,
+        num_workers=args.num_workers,
+        lr_d=args.lr_d,
+        lr_g=args.lr_g,
+        ema_beta=args.ema_beta,
+        eval_every=args.eval_every,
+        patience=args.patience,
+        min_delta=args.min_delta,
+        target_flip_rate=args.target_flip_rate,
+        warm_start_discriminator=args.warm_start_discriminator,
+        warm_start_style=args.warm_start_style,
+        num_frozen=args.num_frozen,
+        unfreeze_every=args.unfreeze_every,
+    )
+
+
+def validate_classifier(args):
+    from validate_classifier import validate_classifier
+
+    validate_classifier(checkpoint_dir=args.checkpoint_dir)
+
+
+def export_counterfactuals(args):
+    from export_counterfactuals import export_counterfactuals
+
+    export_counterfactuals(
+        args.generator_checkpoint,
+        output_dir=args.output_dir,
+        classifier_checkpoint=args.classifier_checkpoint,
+        data_dir=args.data_dir,
+        size_style=args.size_style,
+        depth=args.depth,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        threads=args.threads,
+    )
+
+
+def attribute(args):
+    from pipeline import Pipeline
+
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("command", "func", "cache_dir", "data_dir")
+    }
+    pipeline = Pipeline(config, cache_dir=args.cache_dir, data_dir=args.data_dir)
+    pipeline.run("attributions")
+    print(f"attributions: {pipeline.path('attributions')}")
+
+
+def startup_time():
+    """
+    Time importing this module and parsing a command line in a fresh
+    interpreter. Returns the seconds and the heavy modules that were imported.
+    """
+    import json
+    import subprocess
+    import time
+    from pathlib import Path
+
+    code = (
+        "import json, sys, cli; "
+        "cli.get_arg_parser().parse_args(['validate-classifier']); "
+        "print(json.dumps([m for m in cli.HEAVY_MODULES if m in sys.modules]))"
+    )
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(__file__).parent,
+    )
+    return time.perf_counter() - start, json.loads(result.stdout)
+
+
+def check_startup(args):
+    seconds, heavy = startup_time()
+    print(f"Cold start: {seconds:.2f}s (budget {args.budget:.2f}s)")
+    if heavy:
+        sys.exit(f"Imported at startup: {', '.join(heavy)}")
+    if seconds > args.budget:
+        sys.exit("Startup is over budget")
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sub = subparsers.add_parser("train-classifier")
+    sub.add_argument("--base-dir", default=None)
+    sub.add_argument("--epochs", type=int, default=10)
+    sub.add_argument("--lr", type=float, default=1e-4)
+    sub.add_argument("--data-dir", default=None)
+    sub.add_argument("--num-workers", type=int, default=None)
+    sub.set_defaults(func=train_classifier)
+
+    sub = subparsers.add_parser("train-gan")
+    sub.add_argument("--save-dir", default="checkpoints/stargan")
+    sub.add_argument("--data-dir", default="../data")
+    sub.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    sub.add_argument("--size-style", type=int, default=8)
+    sub.add_argument("--depth", type=int, default=2)
+    sub.add_argument("--batch-size", type=int, default=32)
+    sub.add_argument("--accumulation-steps", type=int, default=1)
+    sub.add_argument("--activation-checkpointing", action="store_true")
+    sub.add_argument("--total-epochs", type=int, default=14)
+    sub.add_argument("--num-workers", type=int, default=None)
+    sub.add_argument("--lr-d", type=float, default=1e-6)
+    sub.add_argument("--lr-g", type=float, default=1e-4)
+    sub.add_argument("--ema-beta", type=float, default=0.999)
+    sub.add_argument("--eval-every", type=int, default=500)
+    sub.add_argument("--patience", type=int, default=5)
+    sub.add_argument("--min-delta", type=float, default=1e-3)
+    sub.add_argument("--target-flip-rate", type=float, default=None)
+    sub.add_argument("--warm-start-discriminator", action="store_true")
+    sub.add_argument("--warm-start-style", action="store_true")
+    sub.add_argument("--num-frozen", type=int, default=0)
+    sub.add_argument("--unfreeze-every", type=int, default=1)
+    sub.set_defaults(func=train_gan)
+
+    sub = subparsers.add_parser("validate-classifier")
+    sub.add_argument("--checkpoint-dir", default="checkpoints")
+    sub.set_defaults(func=validate_classifier)
+
+    sub = subparsers.add_parser("export-counterfactuals")
+    sub.add_argument("generator_checkpoint")
+    sub.add_argument("--output-dir", default="counterfactuals")
+    sub.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    sub.add_argument("--data-dir", default="../data")
+    sub.add_argument("--size-style", type=int, default=8)
+    sub.add_argument("--depth", type=int, default=2)
+    sub.add_argument("--batch-size", type=int, default=None)
+    sub.add_argument("--workers", type=int, default=0)
+    sub.add_argument("--threads", type=int, default=None)
+    sub.set_defaults(func=export_counterfactuals)
+
+    sub = subparsers.add_parser("attribute")
+    add_pipeline_arguments(sub)
+    sub.set_defaults(func=attribute)
+
+    sub = subparsers.add_parser("check-startup")
+    sub.add_argument("--budget", type=float, default=1.0, help="In seconds")
+    sub.set_defaults(func=check_startup)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_arg_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,214 @@
+"""
+Data loading helpers shared by the training and validation scripts.
+
+`make_dataloader` sets up worker processes and pinned host memory, and
+`prefetch` wraps a dataloader so that the next batch is already being copied
+to the device while the current one is being used. `save_outputs` streams a
+model's outputs for a whole dataset into a memory-mapped `.npy` file.
+"""
+
+import numpy as np
+import os
+import queue
+import threading
+import torch
+from pathlib import Path
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from utils import available_cores
+
+
+def default_num_workers():
+    """Use all but one core for loading, but never more than 8 workers"""
+    return min(8, len(available_cores()) - 1)
+
+
+def make_dataloader(
+    dataset,
+    batch_size=32,
+    shuffle=False,
+    drop_last=False,
+    device=None,
+    num_workers=None,
+    prefetch_factor=4,
+    persistent_workers=True,
+    **kwargs,
+):
+    """
+    Create a `DataLoader` with worker processes and pinned memory configured.
+
+    device: torch.device
+        The device the batches will be used on. Host memory is only pinned for
+        CUDA devices.
+    num_workers: int
+        Number of loader processes, defaults to `default_num_workers()`.
+    prefetch_factor: int
+        Number of batches loaded in advance by each worker.
+
+    Any other keyword arguments are passed on to the `DataLoader`. If a
+    `batch_sampler` is given, `batch_size`, `shuffle` and `drop_last` are
+    ignored.
+    """
+    device = torch.device(device or "cpu")
+    if num_workers is None:
+        num_workers = default_num_workers()
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=device.type == "cuda")
+    if "batch_sampler" not in kwargs:
+        loader_kwargs.update(
+            batch_size=batch_size, shuffle=shuffle, drop_last=drop_last
+        )
+    if num_workers > 0:
+        loader_kwargs["persistent_workers"] = persistent_workers
+        loader_kwargs["prefetch_factor"] = prefetch_factor
+    loader_kwargs.update(kwargs)
+    return DataLoader(dataset, **loader_kwargs)
+
+
+def to_device(batch, device, non_blocking=True):
+    """Move a tensor, or a tuple/list of tensors, to `device`"""
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(b, device, non_blocking) for b in batch)
+    return batch
+
+
+class CUDAPrefetcher:
+    """
+    Iterate over a dataloader, copying the next batch to the GPU on a side
+    stream while the current batch is being processed.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.loader)
+
+        def load():
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return to_device(batch, self.device)
+
+        next_batch = load()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # Make sure the caching allocator doesn't reuse the memory early
+            for tensor in batch if isinstance(batch, (list, tuple)) else [batch]:
+                if isinstance(tensor, torch.Tensor):
+                    tensor.record_stream(current_stream)
+            next_batch = load()
+            yield batch
+
+
+class ThreadPrefetcher:
+    """
+    Iterate over a dataloader, loading up to `depth` batches ahead in a
+    background thread.
+    """
+
+    _done = object()
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    if stop.is_set():
+                        return
+                    batches.put(to_device(batch, self.device))
+            except Exception as e:
+                batches.put(e)
+            batches.put(self._done)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is self._done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            # Unblock the worker if it is waiting on a full queue
+            while thread.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.1)
+
+
+def prefetch(loader, device, depth=2):
+    """Wrap `loader` in the prefetcher appropriate for `device`"""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return CUDAPrefetcher(loader, device)
+    return ThreadPrefetcher(loader, device, depth=depth)
+
+
+def save_outputs(
+    func,
+    dataset,
+    path,
+    labels_path,
+    dtype=np.float32,
+    batch_size=256,
+    device=None,
+    desc=None,
+):
+    """
+    Write `func(x)` for every batch of `dataset` to the `.npy` file at `path`,
+    as one `(len(dataset), D)` array of `dtype`, and the labels to
+    `labels_path`. The outputs are written through a memory map, so memory use
+    only depends on the batch size, and renamed last: their presence marks a
+    complete file.
+    """
+    device = torch.device(device or "cpu")
+    dataloader = make_dataloader(dataset, batch_size=batch_size, device=device)
+    batches = prefetch(dataloader, device)
+    if desc is not None:
+        batches = tqdm(batches, desc=desc)
+    tmp_path = Path(path).with_suffix(".tmp")
+    labels = np.empty(len(dataset), dtype=np.int64)
+    outputs = None
+    start = 0
+    with torch.inference_mode():
+        for x, y in batches:
+            batch = func(x).cpu().numpy()
+            if outputs is None:
+                outputs = np.lib.format.open_memmap(
+                    tmp_path,
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(len(dataset), batch.shape[1]),
+                )
+            outputs[start : start + len(batch)] = batch
+            labels[start : start + len(batch)] = y.cpu().numpy()
+            start += len(batch)
+    outputs.flush()
+    del outputs
+    np.save(labels_path, labels)
+    os.replace(tmp_path, path)
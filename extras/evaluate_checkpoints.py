@@ -0,0 +1,153 @@
+"""
+Evaluate the StarGAN checkpoints while the GAN is training.
+
+Run this next to `train_gan.py`: it polls the checkpoint directory for new
+`checkpoint_{epoch}.pth` files, memory-maps the generator weights, and
+computes the counterfactual flip rate and the (target, prediction)
+confusion matrix on a fixed subset of the test set with the frozen
+classifier, as well as the per-class Fréchet distance between the classifier
+features of the counterfactuals and of the real training images (see
+`fid.py`). One line of JSON is appended to `metrics.jsonl` per checkpoint.
+Checkpoints already in the metrics file are skipped, so the evaluator can be
+restarted at any time.
+
+    python evaluate_checkpoints.py checkpoints/stargan --threads 2
+"""
+
+from classifier.data import ColoredMNIST
+from fid import (
+    cached_real_statistics,
+    class_frechet_distances,
+    counterfactual_statistics,
+)
+from gan_metrics import (
+    class_prototypes,
+    counterfactual_confusion_matrix,
+    held_out_subset,
+    load_classifier,
+)
+from train_gan import checkpoint_epoch, load_generator
+import argparse
+import json
+from pathlib import Path
+import time
+import torch
+
+
+def evaluate_checkpoint(generator, classifier, x, y, prototypes, real=None):
+    """
+    Flip rate and confusion matrix of the counterfactuals of `x`, and their
+    per-class Fréchet distances to the `real` feature statistics if given.
+    """
+    matrix = counterfactual_confusion_matrix(generator, classifier, x, y, prototypes)
+    metrics = {
+        "flip_rate": (matrix.diagonal().sum() / matrix.sum()).item(),
+        "confusion_matrix": matrix.tolist(),
+    }
+    if real is not None:
+        fake = counterfactual_statistics(generator, classifier, [(x, y)], prototypes)
+        metrics["frechet_distance"] = class_frechet_distances(real, fake)
+    return metrics
+
+
+def evaluated_checkpoints(metrics_path):
+    """Names of the checkpoints already in the metrics file"""
+    if not metrics_path.exists():
+        return set()
+    with open(metrics_path, "r") as f:
+        return {json.loads(line)["checkpoint"] for line in f if line.strip()}
+
+
+def watch(
+    save_dir="checkpoints/stargan",
+    metrics_path=None,
+    data_dir="../data",
+    classifier_checkpoint="checkpoints/model.pth",
+    size_style=8,
+    depth=2,
+    num_images=256,
+    poll_interval=30,
+    once=False,
+    device="cpu",
+):
+    """
+    Evaluate every new checkpoint in `save_dir`, polling every
+    `poll_interval` seconds. With `once`, exit when there are no checkpoints
+    left to evaluate instead of waiting for more.
+    """
+    save_dir = Path(save_dir)
+    metrics_path = Path(metrics_path or save_dir / "metrics.jsonl")
+    classifier = load_classifier(classifier_checkpoint, device=device)
+    dataset = ColoredMNIST(data_dir, download=True, train=False)
+    # The same subset and prototypes as `train_gan.py`, so the curves match
+    x, y = held_out_subset(dataset, num_images=num_images)
+    x, y = x.to(device), y.to(device)
+    prototypes = class_prototypes(dataset).to(device)
+    real = cached_real_statistics(
+        classifier_checkpoint,
+        ColoredMNIST(data_dir, download=True, train=True),
+        "colored_mnist-train",
+        device=device,
+    )
+
+    done = evaluated_checkpoints(metrics_path)
+    while True:
+        new = [
+            path
+            for path in sorted(save_dir.glob("checkpoint_*.pth"), key=checkpoint_epoch)
+            if path.name not in done
+        ]
+        for path in new:
+            start = time.perf_counter()
+            generator = load_generator(
+                path, size_style=size_style, depth=depth, device=device, mmap=True
+            )
+            metrics = evaluate_checkpoint(
+                generator, classifier, x, y, prototypes, real=real
+            )
+            metrics = {
+                "checkpoint": path.name,
+                "epoch": checkpoint_epoch(path),
+                **metrics,
+                "seconds": time.perf_counter() - start,
+            }
+            with open(metrics_path, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+            done.add(path.name)
+            print(f"{path.name}: flip rate {metrics['flip_rate']:.3f}")
+        if once and not new:
+            return
+        if not new:
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("save_dir", nargs="?", default="checkpoints/stargan")
+    parser.add_argument("--metrics", default=None, help="Defaults to metrics.jsonl")
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    parser.add_argument("--size-style", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--num-images", type=int, default=256)
+    parser.add_argument("--poll-interval", type=float, default=30)
+    parser.add_argument("--once", action="store_true")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument(
+        "--threads", type=int, default=1, help="Keep this low to not slow training"
+    )
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    watch(
+        save_dir=args.save_dir,
+        metrics_path=args.metrics,
+        data_dir=args.data_dir,
+        classifier_checkpoint=args.classifier_checkpoint,
+        size_style=args.size_style,
+        depth=args.depth,
+        num_images=args.num_images,
+        poll_interval=args.poll_interval,
+        once=args.once,
+        device=args.device,
+    )
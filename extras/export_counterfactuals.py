@@ -0,0 +1,353 @@
+"""
+Generate counterfactuals for every test image and every target class, and
+store them on disk as uint8 shards.
+
+Each shard `shard_{k:05d}.npy` holds an array of shape
+`(num_images, num_classes, 3, 28, 28)`, and `shard_{k:05d}.npz` the matching
+manifest: source index, source label, and per target the predicted class and
+its confidence. The manifest is written last, so a shard without one is
+incomplete; re-running the export resumes at the first incomplete shard,
+as long as it uses the same settings and checkpoint contents as recorded in
+`manifest.json`.
+
+With `--workers`, the export runs in a pool of CPU processes instead. The
+model weights are placed in shared memory once, each worker is pinned to its
+own subset of cores, and workers take whole shards from a queue and write
+them straight to the output directory. All incomplete shards are exported.
+
+    python export_counterfactuals.py checkpoints/stargan/best.pth
+    python export_counterfactuals.py checkpoints/stargan/best.pth --workers 8
+"""
+
+from classifier.data import ColoredMNIST
+from autotune import get_config
+from data_pipeline import make_dataloader, prefetch
+from gan_metrics import class_prototypes, load_classifier, translate_to_all_classes
+from shards import (
+    ShardReader,
+    first_incomplete_shard,
+    shard_paths,
+    write_manifest,
+    write_shard,
+)
+from train_gan import load_generator
+from utils import available_cores, file_hash
+import argparse
+import os
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, Subset
+from tqdm import tqdm
+from pathlib import Path
+
+
+def to_uint8(x):
+    """Convert images in [0, 1] to uint8"""
+    return (x * 255).round().clamp(0, 255).to(torch.uint8)
+
+
+class ShardWriter:
+    """
+    Collects counterfactual batches in source index order and writes them out
+    as shards of `shard_size` images, starting at shard `shard`.
+    """
+
+    def __init__(self, output_dir, shard, shard_size):
+        self.output_dir = output_dir
+        self.shard = shard
+        self.shard_size = shard_size
+        self.start = shard * shard_size
+        self.images = []
+        self.manifests = []
+        self.buffered = 0
+
+    def add(self, images, manifest):
+        self.images.append(images)
+        self.manifests.append(manifest)
+        self.buffered += len(images)
+        while self.buffered >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def close(self):
+        """Write out the last, possibly partial, shard"""
+        if self.buffered > 0:
+            self._flush(self.buffered)
+
+    def _flush(self, n):
+        images = np.concatenate(self.images)
+        manifest = {
+            key: np.concatenate([m[key] for m in self.manifests])
+            for key in self.manifests[0]
+        }
+        shard_manifest = {key: value[:n] for key, value in manifest.items()}
+        shard_manifest["source_index"] = np.arange(self.start, self.start + n)
+        write_shard(self.output_dir, self.shard, images[:n], shard_manifest)
+        self.images = [images[n:]]
+        self.manifests = [{key: value[n:] for key, value in manifest.items()}]
+        self.buffered -= n
+        self.start += n
+        self.shard += 1
+
+
+@torch.inference_mode()
+def counterfactual_batch(generator, classifier, x, y, prototypes):
+    """
+    Translate a batch to every class and classify the results.
+    Returns the uint8 counterfactuals and the batch's manifest entries.
+    """
+    x_fake = translate_to_all_classes(generator, x, prototypes)
+    return describe_counterfactuals(classifier, x_fake, y)
+
+
+@torch.inference_mode()
+def describe_counterfactuals(classifier, x_fake, y):
+    """
+    Classify the counterfactuals `x_fake` of shape `(N, num_classes, 3, H, W)`
+    of the images with labels `y`, however they were made. Returns the uint8
+    counterfactuals and their manifest entries.
+    """
+    probabilities = torch.softmax(classifier(x_fake.flatten(0, 1)), dim=1)
+    confidence, prediction = probabilities.max(dim=1)
+    shape = x_fake.shape[:2]
+    return to_uint8(x_fake).cpu().numpy(), {
+        "source_label": y.cpu().numpy(),
+        "prediction": prediction.view(shape).cpu().numpy(),
+        "confidence": confidence.view(shape).cpu().numpy().astype(np.float32),
+    }
+
+
+def export_counterfactuals(
+    generator_checkpoint,
+    output_dir="counterfactuals",
+    classifier_checkpoint="checkpoints/model.pth",
+    data_dir="../data",
+    size_style=8,
+    depth=2,
+    shard_size=1000,
+    batch_size=None,
+    workers=0,
+    threads=None,
+):
+    """
+    Export the counterfactuals of the whole test set, see the module docstring.
+    If `workers` is set, the export runs on CPU in that many processes, each
+    using `threads` cores (by default, the cores are split evenly).
+
+    On CPU, the default batch size and thread count come from `autotune`.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if workers > 0:
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if batch_size is None:
+        batch_size = 256
+        if device.type == "cpu":
+            config = get_config(
+                "generator", apply=workers == 0, depth=depth, size_style=size_style
+            )
+            batch_size = config["batch_size"]
+    dataset = ColoredMNIST(data_dir, download=True, train=False)
+    generator = load_generator(
+        generator_checkpoint, size_style=size_style, depth=depth, device=device
+    )
+    classifier = load_classifier(classifier_checkpoint, device=device)
+    prototypes = class_prototypes(dataset).to(device)
+
+    num_shards = -(-len(dataset) // shard_size)
+    write_manifest(
+        output_dir,
+        {
+            "num_images": len(dataset),
+            "num_classes": len(prototypes),
+            "shard_size": shard_size,
+            "num_shards": num_shards,
+            "size_style": size_style,
+            "depth": depth,
+            # Checkpoints retrained in place are told apart by their content
+            "generator_hash": file_hash(generator_checkpoint),
+            "classifier_hash": file_hash(classifier_checkpoint),
+            "generator_checkpoint": str(generator_checkpoint),
+            "classifier_checkpoint": str(classifier_checkpoint),
+        },
+        unchecked=("generator_checkpoint", "classifier_checkpoint"),
+    )
+    if workers > 0:
+        _export_parallel(
+            generator,
+            classifier,
+            prototypes,
+            data_dir,
+            output_dir,
+            num_shards,
+            shard_size,
+            batch_size,
+            workers,
+            threads,
+        )
+        return
+
+    shard = first_incomplete_shard(output_dir, num_shards)
+    if shard == num_shards:
+        print("All shards have already been exported")
+        return
+    print(f"Starting at shard {shard} of {num_shards}")
+
+    start = shard * shard_size
+    dataloader = make_dataloader(
+        Subset(dataset, range(start, len(dataset))),
+        batch_size=batch_size,
+        shuffle=False,
+        device=device,
+    )
+    writer = ShardWriter(output_dir, shard, shard_size)
+    for x, y in tqdm(prefetch(dataloader, device), desc="Export"):
+        writer.add(*counterfactual_batch(generator, classifier, x, y, prototypes))
+    writer.close()
+
+
+def _export_parallel(
+    generator,
+    classifier,
+    prototypes,
+    data_dir,
+    output_dir,
+    num_shards,
+    shard_size,
+    batch_size,
+    workers,
+    threads,
+):
+    """Export all incomplete shards with a pool of CPU worker processes"""
+    shards = [
+        shard
+        for shard in range(num_shards)
+        if not shard_paths(output_dir, shard)[1].exists()
+    ]
+    if not shards:
+        print("All shards have already been exported")
+        return
+    print(f"Exporting {len(shards)} shards with {workers} workers")
+    if threads is None:
+        threads = max(1, len(available_cores()) // workers)
+
+    # The weights are shared with the workers instead of being copied
+    generator.share_memory()
+    classifier.share_memory()
+    prototypes.share_memory_()
+    queue = mp.get_context("spawn").Queue()
+    for shard in shards:
+        queue.put(shard)
+    for _ in range(workers):
+        queue.put(None)
+    mp.spawn(
+        _export_worker,
+        args=(
+            generator,
+            classifier,
+            prototypes,
+            str(data_dir),
+            str(output_dir),
+            queue,
+            shard_size,
+            batch_size,
+            threads,
+        ),
+        nprocs=workers,
+    )
+
+
+def _export_worker(
+    rank,
+    generator,
+    classifier,
+    prototypes,
+    data_dir,
+    output_dir,
+    queue,
+    shard_size,
+    batch_size,
+    threads,
+):
+    """Pin this worker to its cores, then export shards until the queue is empty"""
+    cores = available_cores()[rank * threads : (rank + 1) * threads]
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    dataset = ColoredMNIST(data_dir, download=False, train=False)
+    while (shard := queue.get()) is not None:
+        start = shard * shard_size
+        stop = min(start + shard_size, len(dataset))
+        writer = ShardWriter(output_dir, shard, shard_size)
+        for batch_start in range(start, stop, batch_size):
+            batch_stop = min(batch_start + batch_size, stop)
+            xs, ys = zip(*(dataset[i] for i in range(batch_start, batch_stop)))
+            writer.add(
+                *counterfactual_batch(
+                    generator, classifier, torch.stack(xs), torch.tensor(ys), prototypes
+                )
+            )
+        writer.close()
+        print(f"Worker {rank}: wrote shard {shard}")
+
+
+class CounterfactualDataset(ShardReader, Dataset):
+    """
+    Read back exported counterfactuals. Item `i` is the counterfactual of
+    source image `i // num_classes` translated to class `i % num_classes`,
+    returned as `(image, target)`. Shards are memory-mapped on first access.
+    """
+
+    def __init__(self, output_dir):
+        super().__init__(output_dir)
+        self.num_classes = self.info["num_classes"]
+
+    def __len__(self):
+        return len(self.manifest["source_index"]) * self.num_classes
+
+    def __getitem__(self, index):
+        image, target = divmod(index, self.num_classes)
+        shard, offset = divmod(image, self.shard_size)
+        x = torch.from_numpy(np.array(self._shard(shard)[offset, target]))
+        return x.float() / 255, target
+
+    def metadata(self, index):
+        """The manifest entry of item `index`"""
+        image, target = divmod(index, self.num_classes)
+        return {
+            "source_index": int(self.manifest["source_index"][image]),
+            "source_label": int(self.manifest["source_label"][image]),
+            "target": target,
+            "prediction": int(self.manifest["prediction"][image, target]),
+            "confidence": float(self.manifest["confidence"][image, target]),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("generator_checkpoint")
+    parser.add_argument("--output-dir", default="counterfactuals")
+    parser.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--size-style", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--shard-size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    export_counterfactuals(
+        args.generator_checkpoint,
+        output_dir=args.output_dir,
+        classifier_checkpoint=args.classifier_checkpoint,
+        data_dir=args.data_dir,
+        size_style=args.size_style,
+        depth=args.depth,
+        shard_size=args.shard_size,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        threads=args.threads,
+    )
@@ -0,0 +1,207 @@
+"""
+Fréchet distance between the classifier features of real images and of
+counterfactuals, per target class (as in FID, with the frozen `DenseModel`
+instead of Inception).
+
+Features are taken from the penultimate layer of the classifier and folded
+into per-class sums and sums of outer products batch by batch, so only the
+`(num_classes, D, D)` statistics are kept in memory. The statistics of the
+real images are computed once and saved as a small `.npz`.
+
+    python fid.py checkpoints/stargan/best.pth
+"""
+
+from gan_metrics import penultimate_features, translate_to_all_classes
+from pathlib import Path
+import argparse
+import numpy as np
+import os
+import torch
+
+
+class FeatureStatistics:
+    """Running per-class mean and covariance of feature vectors"""
+
+    def __init__(self, num_classes=4, num_features=None):
+        self.num_classes = num_classes
+        self.count = np.zeros(num_classes, dtype=np.int64)
+        self.sum = None
+        self.outer = None
+        if num_features is not None:
+            self._allocate(num_features)
+
+    def _allocate(self, num_features):
+        self.sum = np.zeros((self.num_classes, num_features))
+        self.outer = np.zeros((self.num_classes, num_features, num_features))
+
+    def update(self, features, labels):
+        """Add a batch of features of shape `(B, D)` with the class of each"""
+        features = features.detach().to("cpu", torch.float64)
+        labels = labels.detach().cpu()
+        if self.sum is None:
+            self._allocate(features.shape[1])
+        for c in labels.unique().tolist():
+            class_features = features[labels == c]
+            self.count[c] += len(class_features)
+            self.sum[c] += class_features.sum(dim=0).numpy()
+            self.outer[c] += (class_features.T @ class_features).numpy()
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.outer += other.outer
+        return self
+
+    def mean(self):
+        return self.sum / np.maximum(self.count, 1)[:, None]
+
+    def covariance(self):
+        """Sample covariance of each class"""
+        mean = self.mean()
+        count = self.count[:, None, None]
+        scatter = self.outer - count * mean[:, :, None] * mean[:, None, :]
+        return scatter / np.maximum(count - 1, 1)
+
+    def save(self, path):
+        """Write the statistics to a temporary file, then move it to `path`"""
+        path = Path(path)
+        tmp_path = path.with_suffix(".tmp.npz")
+        np.savez(tmp_path, count=self.count, sum=self.sum, outer=self.outer)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            statistics = cls(num_classes=len(saved["count"]))
+            statistics.count = saved["count"]
+            statistics.sum = saved["sum"]
+            statistics.outer = saved["outer"]
+        return statistics
+
+
+def frechet_distance(mean1, covariance1, mean2, covariance2):
+    """
+    ||mean1 - mean2||^2 + tr(C1 + C2 - 2 (C1 C2)^(1/2)). The trace of the
+    matrix square root is computed from the eigenvalues of the symmetric
+    C1^(1/2) C2 C1^(1/2), which has the same eigenvalues as C1 C2.
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance1)
+    sqrt1 = (eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))) @ eigenvectors.T
+    product = np.linalg.eigvalsh(sqrt1 @ covariance2 @ sqrt1)
+    trace_sqrt = np.sqrt(np.clip(product, 0, None)).sum()
+    return float(
+        ((mean1 - mean2) ** 2).sum()
+        + np.trace(covariance1)
+        + np.trace(covariance2)
+        - 2 * trace_sqrt
+    )
+
+
+def class_frechet_distances(real, fake):
+    """Fréchet distance of every class between two `FeatureStatistics`"""
+    real_mean, real_covariance = real.mean(), real.covariance()
+    fake_mean, fake_covariance = fake.mean(), fake.covariance()
+    return [
+        frechet_distance(
+            real_mean[c], real_covariance[c], fake_mean[c], fake_covariance[c]
+        )
+        for c in range(real.num_classes)
+    ]
+
+
+@torch.inference_mode()
+def real_statistics(classifier, batches, num_classes=4):
+    """Feature statistics of the `(x, y)` batches of real images"""
+    statistics = FeatureStatistics(num_classes)
+    for x, y in batches:
+        statistics.update(penultimate_features(classifier, x), y)
+    return statistics
+
+
+def cached_real_statistics(
+    classifier_checkpoint,
+    dataset,
+    name,
+    cache_dir="cache/fid",
+    batch_size=256,
+    device="cpu",
+):
+    """
+    Feature statistics of the real images of `dataset`, computed on first
+    use and loaded from `cache_dir` afterwards. The cache is keyed on the
+    classifier, the `name` of the dataset (e.g. its split) and its size.
+    """
+    from data_pipeline import make_dataloader, prefetch
+    from gan_metrics import load_classifier
+    from utils import file_hash
+
+    key = f"{file_hash(classifier_checkpoint)[:16]}-{name}-{len(dataset)}"
+    path = Path(cache_dir) / f"real-{key}.npz"
+    if path.exists():
+        return FeatureStatistics.load(path)
+    classifier = load_classifier(classifier_checkpoint, device=device)
+    dataloader = make_dataloader(dataset, batch_size=batch_size, device=device)
+    statistics = real_statistics(classifier, prefetch(dataloader, device))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    statistics.save(path)
+    return statistics
+
+
+@torch.inference_mode()
+def counterfactual_statistics(generator, classifier, batches, prototypes):
+    """
+    Feature statistics of the counterfactuals of the `(x, y)` batches, per
+    target class. Targets equal to the source class are not counted.
+    """
+    num_classes = len(prototypes)
+    statistics = FeatureStatistics(num_classes)
+    for x, y in batches:
+        x_fake = translate_to_all_classes(generator, x, prototypes)
+        targets = torch.arange(num_classes, device=x.device).repeat(len(x))
+        mask = targets != y.repeat_interleave(num_classes)
+        features = penultimate_features(classifier, x_fake.flatten(0, 1))
+        statistics.update(features[mask], targets[mask])
+    return statistics
+
+
+if __name__ == "__main__":
+    from classifier.data import ColoredMNIST
+    from data_pipeline import make_dataloader, prefetch
+    from gan_metrics import class_prototypes, load_classifier
+    from train_gan import load_generator
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("generator_checkpoint")
+    parser.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--cache-dir", default="cache/fid")
+    parser.add_argument("--size-style", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    real = cached_real_statistics(
+        args.classifier_checkpoint,
+        ColoredMNIST(args.data_dir, download=True, train=True),
+        "colored_mnist-train",
+        cache_dir=args.cache_dir,
+        batch_size=args.batch_size,
+        device=device,
+    )
+    classifier = load_classifier(args.classifier_checkpoint, device=device)
+    generator = load_generator(
+        args.generator_checkpoint,
+        size_style=args.size_style,
+        depth=args.depth,
+        device=device,
+    )
+    test_data = ColoredMNIST(args.data_dir, download=True, train=False)
+    dataloader = make_dataloader(test_data, batch_size=args.batch_size, device=device)
+    prototypes = class_prototypes(test_data).to(device)
+    fake = counterfactual_statistics(
+        generator, classifier, prefetch(dataloader, device), prototypes
+    )
+    for c, distance in enumerate(class_frechet_distances(real, fake)):
+        print(f"Class {c}: Fréchet distance {distance:.3f}")
@@ -0,0 +1,122 @@
+"""
+Metrics for judging how well the StarGAN generator fools the frozen classifier.
+"""
+
+from classifier.model import DenseModel
+import numpy as np
+import torch
+from torch import nn
+
+
+def load_classifier(checkpoint, device="cpu"):
+    """Load the frozen `DenseModel` classifier from `checkpoint`"""
+    model = DenseModel(input_shape=(3, 28, 28), num_classes=4)
+    model.load_state_dict(
+        torch.load(checkpoint, weights_only=True, map_location=device)
+    )
+    model.to(device)
+    model.eval()
+    model.requires_grad_(False)
+    return model
+
+
+@torch.inference_mode()
+def penultimate_features(classifier, x):
+    """
+    The input of the classifier's last linear layer, the representation it
+    classifies, flattened to shape `(len(x), num_features)`.
+    """
+    last = [m for m in classifier.modules() if isinstance(m, nn.Linear)][-1]
+    features = []
+    handle = last.register_forward_hook(
+        lambda module, inputs, output: features.append(inputs[0])
+    )
+    try:
+        classifier(x)
+    finally:
+        handle.remove()
+    return features[0].flatten(1)
+
+
+def class_prototypes(dataset, num_classes=4, index=0):
+    """
+    One style image per class, stacked into a `(num_classes, 3, 28, 28)` tensor.
+    As in the notebook, the prototype is the `index`-th image of each class.
+    """
+    prototypes = []
+    for i in range(num_classes):
+        options = np.where(dataset.conditions == i)[0]
+        prototypes.append(dataset[options[index]][0])
+    return torch.stack(prototypes)
+
+
+def held_out_subset(dataset, num_images=256, seed=0):
+    """A fixed random subset of `dataset`, returned as stacked `(x, y)` tensors"""
+    rng = np.random.default_rng(seed)
+    indices = rng.choice(len(dataset), num_images, replace=False)
+    xs, ys = zip(*(dataset[i] for i in indices))
+    return torch.stack(xs), torch.tensor(ys)
+
+
+@torch.inference_mode()
+def translate_to_all_classes(generator, x, prototypes):
+    """
+    Translate every image in `x` to every class in a single batched pass,
+    using `prototypes` as the style images.
+
+    Returns the counterfactuals, of shape `(len(x), len(prototypes), 3, H, W)`.
+    """
+    num_images, num_classes = len(x), len(prototypes)
+    was_training = generator.training
+    generator.eval()
+    x_source = x.repeat_interleave(num_classes, dim=0)
+    x_style = prototypes.repeat(num_images, 1, 1, 1)
+    x_fake = generator(x_source, x_style)
+    generator.train(was_training)
+    return x_fake.view(num_images, num_classes, *x_fake.shape[1:])
+
+
+@torch.inference_mode()
+def counterfactual_predictions(generator, classifier, x, prototypes):
+    """
+    Translate every image in `x` to every class and classify the results.
+
+    Returns the targets and the predicted classes, both of shape
+    `(len(x), len(prototypes))`.
+    """
+    num_images, num_classes = len(x), len(prototypes)
+    x_fake = translate_to_all_classes(generator, x, prototypes)
+    predictions = classifier(x_fake.flatten(0, 1)).argmax(dim=1)
+    targets = torch.arange(num_classes, device=x.device).repeat(num_images)
+    return (
+        targets.view(num_images, num_classes),
+        predictions.view(num_images, num_classes),
+    )
+
+
+def flip_rate(generator, classifier, x, y, prototypes):
+    """
+    Fraction of counterfactuals that the classifier assigns to their target
+    class. Targets equal to the source class are not counted.
+    """
+    targets, predictions = counterfactual_predictions(
+        generator, classifier, x, prototypes
+    )
+    mask = targets != y.unsqueeze(1)
+    return (predictions == targets)[mask].float().mean().item()
+
+
+def counterfactual_confusion_matrix(generator, classifier, x, y, prototypes):
+    """
+    Counts of (target class, predicted class) over all counterfactuals, of
+    shape `(num_classes, num_classes)`. Targets equal to the source class
+    are not counted.
+    """
+    num_classes = len(prototypes)
+    targets, predictions = counterfactual_predictions(
+        generator, classifier, x, prototypes
+    )
+    mask = targets != y.unsqueeze(1)
+    pairs = targets[mask] * num_classes + predictions[mask]
+    counts = torch.bincount(pairs, minlength=num_classes**2)
+    return counts.view(num_classes, num_classes)
@@ -0,0 +1,109 @@
+"""
+Persistent cache of the classifier's logits for a whole ColoredMNIST split.
+
+The logits are computed once, in batches, and stored as a float16 `.npy` file
+keyed by the content hash of the checkpoint and the split, next to the labels.
+Afterwards they are memory-mapped, so predictions, confidences and top-k
+classes cost no forward pass. Row `i` belongs to item `i` of the split.
+
+    python logit_cache.py checkpoints/model.pth --split test
+"""
+
+from utils import file_hash, load_split
+from pathlib import Path
+import argparse
+import numpy as np
+import torch
+
+
+class LogitCache:
+    """
+    Logits of the classifier in `checkpoint` for every item of `split`,
+    computed on first use and memory-mapped from `cache_dir` afterwards. With
+    `batch_size=None`, the batch size is autotuned, only if the logits have to
+    be computed.
+    """
+
+    def __init__(
+        self,
+        checkpoint,
+        split="test",
+        data_dir="../data",
+        cache_dir="cache/logits",
+        device=None,
+        batch_size=256,
+        download=True,
+    ):
+        self.checkpoint = checkpoint
+        self.split = split
+        self.key = f"{file_hash(checkpoint)[:16]}-{split}"
+        cache_dir = Path(cache_dir)
+        self.logits_path = cache_dir / f"{self.key}-logits.npy"
+        self.labels_path = cache_dir / f"{self.key}-labels.npy"
+        if not self.logits_path.exists():
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self._compute(data_dir, device, batch_size, download)
+        self.logits = np.load(self.logits_path, mmap_mode="r")
+        self.labels = np.load(self.labels_path, mmap_mode="r")
+
+    def _compute(self, data_dir, device, batch_size, download):
+        from data_pipeline import save_outputs
+        from gan_metrics import load_classifier
+
+        if device is None:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if batch_size is None:
+            from autotune import get_config
+
+            batch_size = get_config("dense_model")["batch_size"]
+        model = load_classifier(self.checkpoint, device=device)
+        save_outputs(
+            model,
+            load_split(data_dir, self.split, download=download),
+            self.logits_path,
+            self.labels_path,
+            dtype=np.float16,
+            batch_size=batch_size,
+            device=device,
+        )
+
+    def _select(self, indices):
+        logits = self.logits if indices is None else self.logits[indices]
+        return np.asarray(logits, dtype=np.float32)
+
+    def predictions(self, indices=None):
+        """Predicted class of every item, or of the items at `indices`"""
+        return self._select(indices).argmax(axis=1)
+
+    def confidences(self, indices=None):
+        """Softmax probability of the predicted class"""
+        return self.probabilities(indices).max(axis=1)
+
+    def probabilities(self, indices=None):
+        logits = self._select(indices)
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def topk(self, k, indices=None):
+        """The `k` most likely classes and their probabilities, most likely first"""
+        probabilities = self.probabilities(indices)
+        classes = np.argsort(-probabilities, axis=1, kind="stable")[:, :k]
+        return classes, np.take_along_axis(probabilities, classes, axis=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint")
+    parser.add_argument("--split", default="test", choices=["train", "test"])
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--cache-dir", default="cache/logits")
+    args = parser.parse_args()
+
+    cache = LogitCache(
+        args.checkpoint,
+        split=args.split,
+        data_dir=args.data_dir,
+        cache_dir=args.cache_dir,
+    )
+    accuracy = (cache.predictions() == cache.labels).mean()
+    print(f"{cache.logits_path}: {len(cache.logits)} items, accuracy {accuracy:.4f}")
@@ -0,0 +1,112 @@
+"""
+Find the smallest part of a counterfactual that is needed to change the
+classifier's decision.
+
+The attribution map of an image (computed with the counterfactual as baseline)
+is thresholded, and the masked region of the counterfactual is pasted onto the
+original image. Sweeping the threshold gives a curve of mask size against the
+classifier's score for the target class. The hybrids for all thresholds and
+images are indexed as one flat batch and classified in chunks, without any
+Python loop over images or thresholds.
+"""
+
+import torch
+
+
+def attribution_masks(attributions, thresholds):
+    """
+    Binary masks of shape `(T, B, 1, H, W)`: the pixels whose absolute
+    attribution, summed over channels and normalized per image to [0, 1], is
+    above each of the `T` thresholds.
+    """
+    saliency = attributions.abs().sum(dim=1, keepdim=True)
+    saliency = saliency / saliency.amax(dim=(2, 3), keepdim=True).clamp_min(1e-12)
+    return saliency.unsqueeze(0) > thresholds.view(-1, 1, 1, 1, 1)
+
+
+@torch.inference_mode()
+def threshold_sweep(
+    model, x, x_fake, attributions, target, thresholds=None, chunk_size=4096
+):
+    """
+    Classify the hybrids of `x` and `x_fake` for every threshold.
+
+    x, x_fake, attributions: torch.Tensor
+        Images, counterfactuals and attributions, all of shape `(B, 3, H, W)`.
+    target: torch.Tensor
+        The target class of each counterfactual, of shape `(B,)`.
+    thresholds: torch.Tensor
+        Decreasing thresholds give increasing mask sizes. Defaults to 21
+        thresholds from 1 to 0.
+
+    Returns a dictionary with the `mask_size` (fraction of pixels) and the
+    target class `score` (softmax) of every hybrid, both of shape `(T, B)`,
+    whether it is classified as the target (`flipped`), and the
+    `minimal_mask_size` per image (NaN if no threshold flips it).
+    """
+    if thresholds is None:
+        thresholds = torch.linspace(1, 0, 21)
+    thresholds = thresholds.to(x.device)
+    masks = attribution_masks(attributions, thresholds)
+    num_thresholds, num_images = masks.shape[:2]
+    mask_size = masks.flatten(2).float().mean(dim=2)
+
+    # Hybrids are only materialized one chunk of (threshold, image) pairs at a time
+    masks = masks.flatten(0, 1)
+    score = torch.empty(num_thresholds * num_images, device=x.device)
+    flipped = torch.empty(
+        num_thresholds * num_images, dtype=torch.bool, device=x.device
+    )
+    for start in range(0, len(masks), chunk_size):
+        index = torch.arange(
+            start, min(start + chunk_size, len(masks)), device=x.device
+        )
+        image = index % num_images
+        hybrids = torch.where(masks[index], x_fake[image], x[image])
+        logits = model(hybrids)
+        score[index] = torch.softmax(logits, dim=1).gather(
+            1, target[image].unsqueeze(1)
+        ).squeeze(1)
+        flipped[index] = logits.argmax(dim=1) == target[image]
+    score = score.view(num_thresholds, num_images)
+    flipped = flipped.view(num_thresholds, num_images)
+
+    minimal_mask_size = torch.where(
+        flipped, mask_size, torch.full_like(mask_size, float("inf"))
+    ).amin(dim=0)
+    minimal_mask_size[minimal_mask_size.isinf()] = float("nan")
+    return {
+        "thresholds": thresholds,
+        "mask_size": mask_size,
+        "score": score,
+        "flipped": flipped,
+        "minimal_mask_size": minimal_mask_size,
+    }
+
+
+def sweep_all_targets(model, x, counterfactuals, attributions, **kwargs):
+    """
+    Run `threshold_sweep` for every (image, target) pair.
+
+    counterfactuals, attributions: torch.Tensor
+        Of shape `(B, C, 3, H, W)`, for each image and each of the `C` targets.
+
+    Returns the same results as `threshold_sweep`, with the image axis
+    replaced by `(B, C)`.
+    """
+    num_images, num_classes = counterfactuals.shape[:2]
+    target = torch.arange(num_classes, device=x.device).repeat(num_images)
+    results = threshold_sweep(
+        model,
+        x.repeat_interleave(num_classes, dim=0),
+        counterfactuals.flatten(0, 1),
+        attributions.flatten(0, 1),
+        target,
+        **kwargs,
+    )
+    for key in ("mask_size", "score", "flipped"):
+        results[key] = results[key].view(-1, num_images, num_classes)
+    results["minimal_mask_size"] = results["minimal_mask_size"].view(
+        num_images, num_classes
+    )
+    return results
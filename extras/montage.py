@@ -0,0 +1,204 @@
+"""
+Render (image, counterfactual, attribution) triplets as large PNG review
+sheets, without matplotlib.
+
+Each triplet becomes a tile: a text label above the image, its
+counterfactual and its absolute attribution normalized per image to [0, 1],
+as in `visualize_color_attribution_and_counterfactual` in `solution.py`.
+Tiles are assembled into pages of `rows x cols` with NumPy reshapes, and the
+labels are drawn from a cached atlas of glyphs of PIL's default font. A whole
+test set renders in seconds.
+
+    python montage.py --output-dir review --target-class 2 --num-images 10000
+"""
+
+from functools import lru_cache
+from pathlib import Path
+import argparse
+import numpy as np
+import torch
+
+GLYPHS = "".join(chr(code) for code in range(32, 127))
+
+
+def _to_numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def to_uint8_hwc(images):
+    """Convert `(N, 3, H, W)` images in [0, 1] to `(N, H, W, 3)` uint8"""
+    images = np.clip(_to_numpy(images) * 255 + 0.5, 0, 255).astype(np.uint8)
+    return images.transpose(0, 2, 3, 1)
+
+
+def normalize_attribution(attributions):
+    """Absolute attributions divided by their maximum, per image"""
+    attributions = np.abs(_to_numpy(attributions))
+    maximum = attributions.max(axis=(1, 2, 3), keepdims=True)
+    return attributions / np.maximum(maximum, 1e-12)
+
+
+@lru_cache(maxsize=None)
+def glyph_atlas():
+    """
+    Masks of the printable ASCII characters in PIL's default font, as a uint8
+    array of shape `(len(GLYPHS), height, width)`. Every glyph gets the same
+    cell, so text is laid out as a fixed-width font.
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.load_default()
+    boxes = [font.getbbox(glyph) for glyph in GLYPHS]
+    width = max(right for _, _, right, _ in boxes)
+    height = max(bottom for _, _, _, bottom in boxes)
+    atlas = np.zeros((len(GLYPHS), height, width), dtype=np.uint8)
+    for i, glyph in enumerate(GLYPHS):
+        cell = Image.new("L", (width, height))
+        ImageDraw.Draw(cell).text((0, 0), glyph, fill=255, font=font)
+        atlas[i] = np.asarray(cell)
+    return atlas
+
+
+def render_labels(labels):
+    """
+    Render strings into masks of shape `(N, height, length * width)`, where
+    `length` is that of the longest label. Other characters render as `?`.
+    """
+    atlas = glyph_atlas()
+    length = max(len(label) for label in labels)
+    text = "".join(label.ljust(length) for label in labels)
+    codes = np.frombuffer(text.encode("ascii", "replace"), dtype=np.uint8)
+    codes = codes.astype(np.int64) - ord(" ")
+    codes[(codes < 0) | (codes >= len(GLYPHS))] = GLYPHS.index("?")
+    masks = atlas[codes.reshape(len(labels), length)]
+    num_labels, _, height, width = masks.shape
+    return masks.transpose(0, 2, 1, 3).reshape(num_labels, height, length * width)
+
+
+def triplet_tiles(
+    images, counterfactuals, attributions, labels=None, scale=2, padding=4
+):
+    """
+    One tile per triplet, of shape `(N, tile_height, tile_width, 3)`, with
+    white background and `padding` pixels of space right of and below every
+    panel. Images are upscaled by the integer `scale`.
+    """
+    panels = np.stack(
+        [
+            to_uint8_hwc(images),
+            to_uint8_hwc(counterfactuals),
+            to_uint8_hwc(normalize_attribution(attributions)),
+        ],
+        axis=1,
+    )
+    panels = panels.repeat(scale, axis=2).repeat(scale, axis=3)
+    num_tiles, num_panels, height, width, _ = panels.shape
+    label_height = glyph_atlas().shape[1] + padding if labels is not None else 0
+    tiles = np.full(
+        (num_tiles, label_height + height + padding, num_panels * (width + padding), 3),
+        255,
+        dtype=np.uint8,
+    )
+    row = np.full((num_tiles, height, num_panels, width + padding, 3), 255, np.uint8)
+    row[:, :, :, :width] = panels.transpose(0, 2, 1, 3, 4)
+    tiles[:, label_height : label_height + height] = row.reshape(
+        num_tiles, height, -1, 3
+    )
+    if labels is not None:
+        text = render_labels(labels)[:, :, : tiles.shape[2]]
+        # Black text on the white strip above the panels
+        tiles[:, : text.shape[1], : text.shape[2]] = 255 - text[..., None]
+    return tiles
+
+
+def montage(tiles, rows, cols):
+    """Arrange up to `rows * cols` tiles into one page, filling rows first"""
+    num_tiles, height, width, channels = tiles.shape
+    grid = np.full((rows * cols, height, width, channels), 255, dtype=np.uint8)
+    grid[:num_tiles] = tiles
+    grid = grid.reshape(rows, cols, height, width, channels).transpose(0, 2, 1, 3, 4)
+    return grid.reshape(rows * height, cols * width, channels)
+
+
+def review_sheets(
+    images,
+    counterfactuals,
+    attributions,
+    output_dir,
+    labels=None,
+    rows=16,
+    cols=6,
+    scale=2,
+):
+    """
+    Write PNG pages of `rows * cols` triplets to `output_dir`. The inputs are
+    `(N, 3, H, W)` arrays or tensors (they may be memory-mapped), and only one
+    page is in memory at a time. Returns the paths of the pages.
+    """
+    from PIL import Image
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    per_page = rows * cols
+    paths = []
+    for page, start in enumerate(range(0, len(images), per_page)):
+        end = start + per_page
+        tiles = triplet_tiles(
+            images[start:end],
+            counterfactuals[start:end],
+            attributions[start:end],
+            labels=None if labels is None else labels[start:end],
+            scale=scale,
+        )
+        path = output_dir / f"page_{page:04d}.png"
+        # Fast compression, the pages are for reviewing, not archiving
+        Image.fromarray(montage(tiles, rows, cols)).save(path, compress_level=1)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    from pipeline import Pipeline, get_arg_parser
+
+    parser = argparse.ArgumentParser(
+        description="Other options are passed on to pipeline.py"
+    )
+    parser.add_argument("--output-dir", default="review")
+    parser.add_argument("--rows", type=int, default=16)
+    parser.add_argument("--cols", type=int, default=6)
+    parser.add_argument("--scale", type=int, default=2)
+    args, pipeline_argv = parser.parse_known_args()
+    pipeline_args = get_arg_parser().parse_args(["attributions", *pipeline_argv])
+    if pipeline_args.baseline != "counterfactual":
+        parser.error("The review sheets need --baseline counterfactual")
+
+    config = {
+        key: value
+        for key, value in vars(pipeline_args).items()
+        if key not in ("stages", "cache_dir", "data_dir")
+    }
+    pipeline = Pipeline(
+        config, cache_dir=pipeline_args.cache_dir, data_dir=pipeline_args.data_dir
+    )
+    target = pipeline_args.target_class
+    images = pipeline.run("images")
+    counterfactuals = pipeline.run("counterfactuals")
+    attributions = pipeline.run("attributions")["attributions"]
+    confidence = torch.softmax(counterfactuals["logits"][:, target], dim=1)[:, target]
+    labels = [
+        f"{y}->{target} p={p:.2f}"
+        for y, p in zip(images["y"].tolist(), confidence.tolist())
+    ]
+    paths = review_sheets(
+        images["x"],
+        counterfactuals["x_fake"][:, target],
+        attributions,
+        args.output_dir,
+        labels=labels,
+        rows=args.rows,
+        cols=args.cols,
+        scale=args.scale,
+    )
+    print(f"Wrote {len(paths)} pages to {args.output_dir}")
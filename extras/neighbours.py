@@ -0,0 +1,182 @@
+"""
+Nearest real training images of counterfactuals, to judge how realistic they
+are, in raw pixel space and in the classifier's penultimate-feature space.
+
+The training set is embedded once into a memory-mapped `.npy` index per
+space. Queries are answered in batches with chunked matrix multiplications,
+using ||q - r||^2 = ||q||^2 - 2 q.r + ||r||^2 and keeping a running top-k
+per query, so memory only depends on the query batch and chunk sizes.
+Searches can be restricted to the real images of one class per query, which
+gives the distance of every counterfactual to the nearest real image of its
+target class.
+
+    python neighbours.py counterfactuals --output nearest_real.npz
+"""
+
+from data_pipeline import make_dataloader, prefetch, save_outputs
+from functools import partial
+from gan_metrics import load_classifier, penultimate_features
+from pathlib import Path
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+
+SPACES = ("pixel", "feature")
+
+
+def embed(x, space, classifier=None):
+    """Vectors of the images `x` in `space`, of shape `(len(x), D)`"""
+    if space == "pixel":
+        return x.flatten(1).float()
+    if space == "feature":
+        return penultimate_features(classifier, x).float()
+    raise ValueError(f"Unknown space {space}")
+
+
+class RealIndex:
+    """
+    The vectors of all real images in one space, with their labels. The
+    vectors are an `(N, D)` array, typically memory-mapped.
+    """
+
+    def __init__(self, vectors, labels, chunk_size=8192):
+        self.vectors = vectors
+        self.labels = torch.from_numpy(np.asarray(labels))
+        self.chunk_size = chunk_size
+        self.norms = torch.cat(
+            [
+                (torch.from_numpy(np.asarray(chunk)) ** 2).sum(dim=1)
+                for chunk in self._chunks()
+            ]
+        )
+
+    def _chunks(self):
+        for start in range(0, len(self.vectors), self.chunk_size):
+            yield self.vectors[start : start + self.chunk_size]
+
+    @classmethod
+    def build(
+        cls, path, dataset, space="pixel", classifier=None, batch_size=512, device="cpu"
+    ):
+        """Embed `dataset` into the index at `path`, unless it already exists"""
+        path = Path(path)
+        labels_path = path.with_name(f"{path.stem}_labels.npy")
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            save_outputs(
+                partial(embed, space=space, classifier=classifier),
+                dataset,
+                path,
+                labels_path,
+                batch_size=batch_size,
+                device=device,
+                desc=f"Index {space}",
+            )
+        return cls(np.load(path, mmap_mode="r"), np.load(labels_path))
+
+    def search(self, queries, k=1, classes=None, device="cpu"):
+        """
+        The `k` nearest real images of every query, as `(distances, indices)`
+        of shape `(len(queries), k)`, nearest first.
+
+        classes: torch.Tensor
+            If given, only the real images of class `classes[i]` are searched
+            for query `i`. Missing neighbours have distance inf and index -1.
+        """
+        queries = queries.to(device).float()
+        query_norms = (queries**2).sum(dim=1, keepdim=True)
+        best_distances = torch.full((len(queries), k), float("inf"), device=device)
+        best_indices = torch.full((len(queries), k), -1, device=device)
+        if classes is not None:
+            classes = classes.to(device).unsqueeze(1)
+        start = 0
+        for chunk in self._chunks():
+            end = start + len(chunk)
+            chunk = torch.from_numpy(np.asarray(chunk)).to(device)
+            distances = (
+                query_norms
+                - 2 * queries @ chunk.T
+                + self.norms[start:end].to(device).unsqueeze(0)
+            )
+            if classes is not None:
+                other_class = self.labels[start:end].to(device).unsqueeze(0) != classes
+                distances = distances.masked_fill(other_class, float("inf"))
+            indices = torch.arange(start, end, device=device).expand_as(distances)
+            distances = torch.cat([best_distances, distances], dim=1)
+            indices = torch.cat([best_indices, indices], dim=1)
+            best_distances, position = distances.topk(k, dim=1, largest=False)
+            best_indices = indices.gather(1, position)
+            start = end
+        return best_distances.clamp_min(0).sqrt(), best_indices
+
+
+def nearest_real(
+    counterfactuals, indexes, classifier=None, k=1, batch_size=1024, device="cpu"
+):
+    """
+    Distance of every item of the `CounterfactualDataset` `counterfactuals`
+    to its `k` nearest real images of its target class, in every space of
+    the `{space: RealIndex}` dictionary `indexes`.
+
+    Returns arrays `target`, `{space}_distance` and `{space}_index`, with one
+    row per counterfactual.
+    """
+    dataloader = make_dataloader(counterfactuals, batch_size=batch_size, device=device)
+    results = {"target": []}
+    for space in indexes:
+        results[f"{space}_distance"] = []
+        results[f"{space}_index"] = []
+    with torch.inference_mode():
+        for x, target in tqdm(prefetch(dataloader, device), desc="Counterfactuals"):
+            results["target"].append(target.cpu())
+            for space, index in indexes.items():
+                distances, indices = index.search(
+                    embed(x, space, classifier), k=k, classes=target, device=device
+                )
+                results[f"{space}_distance"].append(distances.cpu())
+                results[f"{space}_index"].append(indices.cpu())
+    return {key: torch.cat(value).numpy() for key, value in results.items()}
+
+
+if __name__ == "__main__":
+    from classifier.data import ColoredMNIST
+    from export_counterfactuals import CounterfactualDataset
+    from utils import file_hash
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("counterfactual_dir")
+    parser.add_argument("--output", default="nearest_real.npz")
+    parser.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--index-dir", default="cache/neighbours")
+    parser.add_argument("--spaces", nargs="+", default=list(SPACES), choices=SPACES)
+    parser.add_argument("-k", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    classifier = load_classifier(args.classifier_checkpoint, device=device)
+    train_data = ColoredMNIST(args.data_dir, download=True, train=True)
+    index_dir = Path(args.index_dir)
+    indexes = {}
+    for space in args.spaces:
+        name = "pixel.npy"
+        if space == "feature":
+            # The features depend on the classifier weights
+            name = f"feature-{file_hash(args.classifier_checkpoint)[:16]}.npy"
+        indexes[space] = RealIndex.build(
+            index_dir / name, train_data, space, classifier, device=device
+        )
+    results = nearest_real(
+        CounterfactualDataset(args.counterfactual_dir),
+        indexes,
+        classifier,
+        k=args.k,
+        batch_size=args.batch_size,
+        device=device,
+    )
+    np.savez(args.output, **results)
+    for space in args.spaces:
+        distance = results[f"{space}_distance"][:, 0]
+        print(f"{space}: median distance to nearest real {np.median(distance):.3f}")
@@ -0,0 +1,132 @@
+"""
+Export the `Generator` and the `DenseModel` classifier to ONNX, and run them
+with onnxruntime on CPU.
+
+`OnnxModel` has the same call signature as the PyTorch module it was exported
+from, so either backend can be used interchangeably. Running this script
+exports both models, checks that their outputs match PyTorch, and compares
+the latency and throughput of both backends. Requires the `onnx` and
+`onnxruntime` packages.
+
+    python onnx_export.py checkpoints/stargan/best.pth --output-dir checkpoints/onnx
+"""
+
+from gan_metrics import load_classifier
+from train_gan import load_generator
+import argparse
+import time
+import numpy as np
+import torch
+from pathlib import Path
+
+
+def export_classifier(classifier, path):
+    """Export the classifier, with a dynamic batch axis"""
+    x = torch.rand(2, 3, 28, 28)
+    torch.onnx.export(
+        classifier.cpu().eval(),
+        (x,),
+        path,
+        input_names=["x"],
+        output_names=["logits"],
+        dynamic_axes={"x": {0: "batch"}, "logits": {0: "batch"}},
+    )
+
+
+def export_generator(generator, path):
+    """Export the generator (UNet and style encoder), with a dynamic batch axis"""
+    x = torch.rand(2, 3, 28, 28)
+    style = torch.rand(2, 3, 28, 28)
+    torch.onnx.export(
+        generator.cpu().eval(),
+        (x, style),
+        path,
+        input_names=["x", "y"],
+        output_names=["x_fake"],
+        dynamic_axes={"x": {0: "batch"}, "y": {0: "batch"}, "x_fake": {0: "batch"}},
+    )
+
+
+class OnnxModel:
+    """
+    Run an exported model with onnxruntime's CPU provider. Called with torch
+    tensors, in the same order as the original module, and returns a tensor.
+    """
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            str(path), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        feed = {
+            name: x.detach().cpu().numpy().astype(np.float32)
+            for name, x in zip(self.input_names, inputs)
+        }
+        return torch.from_numpy(self.session.run(None, feed)[0])
+
+
+@torch.inference_mode()
+def check_parity(module, onnx_model, inputs, atol=1e-4):
+    """Maximum absolute difference between both backends, raises if above `atol`"""
+    expected = module(*inputs)
+    actual = onnx_model(*inputs)
+    difference = (expected - actual).abs().max().item()
+    if difference > atol:
+        raise AssertionError(f"ONNX output differs from PyTorch by {difference}")
+    return difference
+
+
+@torch.inference_mode()
+def benchmark(model, inputs, num_runs=50):
+    """Mean latency in ms and throughput in images per second"""
+    for _ in range(5):
+        model(*inputs)
+    start = time.perf_counter()
+    for _ in range(num_runs):
+        model(*inputs)
+    elapsed = (time.perf_counter() - start) / num_runs
+    return elapsed * 1000, len(inputs[0]) / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("generator_checkpoint")
+    parser.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    parser.add_argument("--output-dir", default="checkpoints/onnx")
+    parser.add_argument("--size-style", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=2)
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    classifier = load_classifier(args.classifier_checkpoint)
+    generator = load_generator(
+        args.generator_checkpoint, size_style=args.size_style, depth=args.depth
+    )
+    export_classifier(classifier, output_dir / "classifier.onnx")
+    export_generator(generator, output_dir / "generator.onnx")
+    onnx_classifier = OnnxModel(output_dir / "classifier.onnx")
+    onnx_generator = OnnxModel(output_dir / "generator.onnx")
+
+    for batch_size in (1, 32, 256):
+        x = torch.rand(batch_size, 3, 28, 28)
+        style = torch.rand(batch_size, 3, 28, 28)
+        for name, module, onnx_model, inputs in [
+            ("classifier", classifier, onnx_classifier, (x,)),
+            ("generator", generator, onnx_generator, (x, style)),
+        ]:
+            difference = check_parity(module, onnx_model, inputs)
+            torch_ms, torch_throughput = benchmark(module, inputs)
+            onnx_ms, onnx_throughput = benchmark(onnx_model, inputs)
+            print(
+                f"{name} batch {batch_size}: max diff {difference:.2e} | "
+                f"torch {torch_ms:.2f} ms ({torch_throughput:.0f} img/s) | "
+                f"onnxruntime {onnx_ms:.2f} ms ({onnx_throughput:.0f} img/s)"
+            )
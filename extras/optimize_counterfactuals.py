@@ -0,0 +1,199 @@
+"""
+Counterfactuals without a GAN: optimize a perturbation of each image until
+the frozen classifier assigns it to the target class.
+
+The perturbation is regularized towards the source image with an L1 and a
+total variation penalty. A whole batch is optimized at once; every image
+stops as soon as its target probability reaches `confidence` and is removed
+from the batch, and the loop ends when all have. The result has the same
+shape as `gan_metrics.translate_to_all_classes`, and the export writes the
+same shards and manifests as `export_counterfactuals.py`, so either can be
+used by the downstream stages.
+
+    python optimize_counterfactuals.py --output-dir counterfactuals_optimized
+"""
+
+from gan_metrics import load_classifier
+import argparse
+from pathlib import Path
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+
+def total_variation(x):
+    """Mean absolute difference between neighbouring pixels, per image"""
+    vertical = (x[..., 1:, :] - x[..., :-1, :]).abs().flatten(1).mean(dim=1)
+    horizontal = (x[..., :, 1:] - x[..., :, :-1]).abs().flatten(1).mean(dim=1)
+    return vertical + horizontal
+
+
+def optimize_counterfactuals(
+    classifier,
+    x,
+    target,
+    l1_weight=0.1,
+    tv_weight=0.1,
+    lr=0.01,
+    max_steps=300,
+    confidence=0.9,
+):
+    """
+    Optimize the counterfactuals of the images `x` for the classes `target`.
+
+    Returns the counterfactuals, and the number of steps each one needed
+    (`max_steps` if it never reached `confidence`, in which case the last
+    iterate is returned).
+    """
+    x = x.detach().clone()
+    delta = torch.zeros_like(x, requires_grad=True)
+    optimizer = torch.optim.Adam([delta], lr=lr)
+    result = x.clone()
+    steps = torch.full((len(x),), max_steps, device=x.device)
+    # Indices of the unfinished images, the rows of `delta`
+    active = torch.arange(len(x), device=x.device)
+    with torch.enable_grad():
+        for step in range(max_steps):
+            x_fake = (x[active] + delta).clamp(0, 1)
+            logits = classifier(x_fake)
+            probability = torch.softmax(logits.detach(), dim=1)
+            target_active = target[active]
+            done = probability.gather(1, target_active[:, None])[:, 0] >= confidence
+            # Finished images keep the iterate that reached the target
+            result[active[done]] = x_fake.detach()[done]
+            steps[active[done]] = step
+            if done.all():
+                return result, steps
+            loss = (
+                F.cross_entropy(logits, target_active, reduction="none")
+                + l1_weight * delta.abs().flatten(1).mean(dim=1)
+                + tv_weight * total_variation(delta)
+            )
+            optimizer.zero_grad()
+            (loss * ~done).sum().backward()
+            optimizer.step()
+            if done.any():
+                # Drop the finished images from the batch and from Adam's state
+                active = active[~done]
+                delta = _compact(optimizer, delta, ~done)
+    result[active] = (x[active] + delta).clamp(0, 1).detach()
+    return result, steps
+
+
+def _compact(optimizer, delta, keep):
+    """
+    Replace the parameter `delta` of `optimizer` with its rows `keep`, and
+    keep the matching rows of the optimizer's state.
+    """
+    state = optimizer.state.pop(delta, {})
+    compact = delta.detach()[keep].requires_grad_()
+    optimizer.param_groups[0]["params"] = [compact]
+    optimizer.state[compact] = {
+        key: value[keep] if torch.is_tensor(value) and value.dim() > 0 else value
+        for key, value in state.items()
+    }
+    return compact
+
+
+def optimize_to_all_classes(classifier, x, num_classes=4, **kwargs):
+    """
+    Optimize a counterfactual of every image in `x` for every class, in a
+    single batch.
+
+    Returns the counterfactuals, of shape `(len(x), num_classes, 3, H, W)`,
+    and the number of steps of each, of shape `(len(x), num_classes)`.
+    """
+    num_images = len(x)
+    target = torch.arange(num_classes, device=x.device).repeat(num_images)
+    x_fake, steps = optimize_counterfactuals(
+        classifier, x.repeat_interleave(num_classes, dim=0), target, **kwargs
+    )
+    return (
+        x_fake.view(num_images, num_classes, *x_fake.shape[1:]),
+        steps.view(num_images, num_classes),
+    )
+
+
+def export_optimized_counterfactuals(
+    output_dir="counterfactuals_optimized",
+    classifier_checkpoint="checkpoints/model.pth",
+    data_dir="../data",
+    shard_size=1000,
+    batch_size=256,
+    **kwargs,
+):
+    """
+    Export the optimized counterfactuals of the whole test set in the format
+    of `export_counterfactuals`, resuming at the first incomplete shard.
+    `kwargs` are passed to `optimize_counterfactuals`.
+    """
+    from classifier.data import ColoredMNIST
+    from data_pipeline import make_dataloader, prefetch
+    from export_counterfactuals import ShardWriter, describe_counterfactuals
+    from shards import first_incomplete_shard, write_manifest
+    from torch.utils.data import Subset
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dataset = ColoredMNIST(data_dir, download=True, train=False)
+    classifier = load_classifier(classifier_checkpoint, device=device)
+    num_classes = len(dataset.classes)
+
+    num_shards = -(-len(dataset) // shard_size)
+    write_manifest(
+        output_dir,
+        {
+            "num_images": len(dataset),
+            "num_classes": num_classes,
+            "shard_size": shard_size,
+            "num_shards": num_shards,
+            "method": "optimizer",
+            "optimizer": kwargs,
+            "classifier_checkpoint": str(classifier_checkpoint),
+        },
+    )
+    shard = first_incomplete_shard(output_dir, num_shards)
+    if shard == num_shards:
+        print("All shards have already been exported")
+        return
+    print(f"Starting at shard {shard} of {num_shards}")
+
+    dataloader = make_dataloader(
+        Subset(dataset, range(shard * shard_size, len(dataset))),
+        batch_size=batch_size,
+        device=device,
+    )
+    writer = ShardWriter(output_dir, shard, shard_size)
+    for x, y in tqdm(prefetch(dataloader, device), desc="Export"):
+        x_fake, _ = optimize_to_all_classes(classifier, x, num_classes, **kwargs)
+        writer.add(*describe_counterfactuals(classifier, x_fake, y))
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-dir", default="counterfactuals_optimized")
+    parser.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--shard-size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--l1-weight", type=float, default=0.1)
+    parser.add_argument("--tv-weight", type=float, default=0.1)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--max-steps", type=int, default=300)
+    parser.add_argument("--confidence", type=float, default=0.9)
+    args = parser.parse_args()
+
+    export_optimized_counterfactuals(
+        output_dir=args.output_dir,
+        classifier_checkpoint=args.classifier_checkpoint,
+        data_dir=args.data_dir,
+        shard_size=args.shard_size,
+        batch_size=args.batch_size,
+        l1_weight=args.l1_weight,
+        tv_weight=args.tv_weight,
+        lr=args.lr,
+        max_steps=args.max_steps,
+        confidence=args.confidence,
+    )
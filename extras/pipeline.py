@@ -0,0 +1,349 @@
+"""
+Headless version of the analysis in `solution.py`, split into cached stages.
+
+Every stage declares the stages it depends on and the parameters it uses. Its
+result is stored in `cache_dir/{stage}/{key}.pt`, where the key is a hash of
+the stage's parameters, the content of any checkpoint it uses, and the keys of
+its inputs. Changing a parameter therefore only re-runs the stages that depend
+on it; for example, changing `--baseline` re-runs the attributions but reuses
+the cached images, predictions and counterfactuals.
+
+    python pipeline.py attributions --baseline counterfactual \\
+        --generator-checkpoint checkpoints/stargan/best.pth
+"""
+
+import argparse
+import hashlib
+import json
+import numpy as np
+import os
+import torch
+from pathlib import Path
+from pipeline_args import add_pipeline_arguments
+from utils import file_hash, load_split
+
+
+STAGES = {}
+
+
+def stage(inputs=(), params=()):
+    """
+    Register a stage. `inputs` are the names of the stages whose results are
+    passed to it, or a function of the configuration returning those names.
+    `params` are the names of the configuration values it is called with, or
+    likewise a function returning them.
+    """
+
+    def register(func):
+        STAGES[func.__name__] = (func, inputs, params)
+        return func
+
+    return register
+
+
+@stage(params=("classifier_checkpoint", "split"))
+def predictions(classifier_checkpoint, split, data_dir, device):
+    """Classifier logits and labels for the whole split"""
+    from logit_cache import LogitCache
+
+    # Shared with every other script that needs the classifier's predictions
+    cache = LogitCache(
+        classifier_checkpoint, split=split, data_dir=data_dir, device=device
+    )
+    return {
+        "logits": torch.from_numpy(np.asarray(cache.logits, dtype=np.float32)),
+        "labels": torch.from_numpy(np.asarray(cache.labels)),
+    }
+
+
+@stage(params=("split", "num_images", "seed"))
+def images(split, num_images, seed, data_dir, device):
+    """A fixed random subset of the split, as in the notebook"""
+    dataset = load_split(data_dir, split)
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:num_images]
+    xs, ys = zip(*(dataset[i] for i in indices.tolist()))
+    return {"indices": indices, "x": torch.stack(xs), "y": torch.tensor(ys)}
+
+
+def counterfactual_translator(
+    counterfactual_method,
+    classifier,
+    prototypes,
+    generator_checkpoint=None,
+    size_style=None,
+    depth=None,
+    device=None,
+):
+    """
+    A function translating a batch of images to every class, with the
+    StarGAN generator or with `optimize_counterfactuals`. The counterfactuals
+    have shape `(B, num_classes, 3, H, W)`.
+    """
+    if counterfactual_method == "optimizer":
+        from optimize_counterfactuals import optimize_to_all_classes
+
+        return lambda x: optimize_to_all_classes(classifier, x, len(prototypes))[0]
+    if counterfactual_method != "generator":
+        raise ValueError(f"Unknown counterfactual method {counterfactual_method}")
+    from gan_metrics import translate_to_all_classes
+    from train_gan import load_generator
+
+    generator = load_generator(
+        generator_checkpoint, size_style=size_style, depth=depth, device=device
+    )
+
+    @torch.no_grad()
+    def translate(x):
+        return translate_to_all_classes(generator, x, prototypes)
+
+    return translate
+
+
+def make_baselines(x, baseline, random_generator=None, counterfactuals=None):
+    """
+    The `zeros`, `random`, `blurred` or `counterfactual` baselines of the
+    batch `x`. Random baselines are drawn from `random_generator`, and the
+    counterfactual baselines are `counterfactuals`.
+    """
+    from torchvision.transforms.functional import gaussian_blur
+
+    if baseline == "zeros":
+        return torch.zeros_like(x)
+    if baseline == "random":
+        return torch.rand(x.shape, generator=random_generator).to(x.device)
+    if baseline == "blurred":
+        return gaussian_blur(x, kernel_size=(5, 5))
+    if baseline == "counterfactual":
+        return counterfactuals.to(x.device)
+    raise ValueError(f"Unknown baseline {baseline}")
+
+
+def attribute_batch(model, x, y, baselines, ig_tolerance=None):
+    """
+    Integrated gradients of `model` for the classes `y`, and the number of
+    steps used for each image. If `ig_tolerance` is set, the steps are chosen
+    per image with `adaptive_ig.adaptive_attribute`, otherwise captum's
+    default is used.
+    """
+    from adaptive_ig import adaptive_attribute
+    from captum.attr import IntegratedGradients
+
+    if ig_tolerance is None:
+        attribution = IntegratedGradients(model).attribute(
+            x, target=y, baselines=baselines
+        )
+        return attribution.detach(), torch.full((len(x),), 50)
+    attribution, _, steps = adaptive_attribute(
+        model, x, y, baselines=baselines, tolerance=ig_tolerance
+    )
+    return attribution.detach(), steps
+
+
+def _counterfactual_params(config):
+    if config["counterfactual_method"] == "optimizer":
+        return ("counterfactual_method", "classifier_checkpoint")
+    return (
+        "counterfactual_method",
+        "generator_checkpoint",
+        "classifier_checkpoint",
+        "size_style",
+        "depth",
+    )
+
+
+@stage(inputs=("images",), params=_counterfactual_params)
+def counterfactuals(
+    images,
+    counterfactual_method,
+    classifier_checkpoint,
+    data_dir,
+    device,
+    generator_checkpoint=None,
+    size_style=None,
+    depth=None,
+    batch_size=256,
+):
+    """
+    Translate every image to every class, with the StarGAN generator using the
+    class prototypes as style, or with `optimize_counterfactuals`.
+    """
+    from gan_metrics import class_prototypes, load_classifier
+
+    classifier = load_classifier(classifier_checkpoint, device=device)
+    prototypes = class_prototypes(load_split(data_dir, "test")).to(device)
+    translate = counterfactual_translator(
+        counterfactual_method,
+        classifier,
+        prototypes,
+        generator_checkpoint=generator_checkpoint,
+        size_style=size_style,
+        depth=depth,
+        device=device,
+    )
+    x_fake, predicted = [], []
+    for x in images["x"].split(batch_size):
+        fake = translate(x.to(device))
+        with torch.inference_mode():
+            predicted.append(classifier(fake.flatten(0, 1)).view(*fake.shape[:2], -1))
+        x_fake.append(fake.cpu())
+    return {"x_fake": torch.cat(x_fake), "logits": torch.cat(predicted).cpu()}
+
+
+def _attribution_inputs(config):
+    if config["baseline"] == "counterfactual":
+        return ("images", "counterfactuals")
+    return ("images",)
+
+
+def _attribution_params(config):
+    params = ("classifier_checkpoint", "baseline", "ig_tolerance")
+    # Only the baselines that use them depend on the target class and seed
+    if config["baseline"] == "counterfactual":
+        params += ("target_class",)
+    elif config["baseline"] == "random":
+        params += ("seed",)
+    return params
+
+
+@stage(inputs=_attribution_inputs, params=_attribution_params)
+def attributions(
+    images,
+    classifier_checkpoint,
+    baseline,
+    ig_tolerance,
+    data_dir,
+    device,
+    counterfactuals=None,
+    target_class=None,
+    seed=None,
+    batch_size=64,
+):
+    """
+    Integrated gradients of the classifier for the true class, with a `zeros`,
+    `random`, `blurred` or `counterfactual` baseline. The counterfactual
+    baseline is the translation of each image to `target_class`, the random
+    baseline is drawn with `seed`.
+
+    If `ig_tolerance` is set, the number of integration steps is chosen per
+    image with `adaptive_ig.adaptive_attribute`, otherwise captum's default is
+    used for all images.
+    """
+    from gan_metrics import load_classifier
+
+    model = load_classifier(classifier_checkpoint, device=device)
+    random_generator = None
+    if baseline == "random":
+        random_generator = torch.Generator().manual_seed(seed)
+    results, num_steps = [], []
+    for i in range(0, len(images["x"]), batch_size):
+        x = images["x"][i : i + batch_size].to(device)
+        y = images["y"][i : i + batch_size].to(device)
+        counterfactual = None
+        if baseline == "counterfactual":
+            counterfactual = counterfactuals["x_fake"][i : i + batch_size, target_class]
+        baselines = make_baselines(x, baseline, random_generator, counterfactual)
+        attribution, steps = attribute_batch(model, x, y, baselines, ig_tolerance)
+        results.append(attribution.cpu())
+        num_steps.append(steps.cpu())
+    return {"attributions": torch.cat(results), "num_steps": torch.cat(num_steps)}
+
+
+@stage(inputs=("images",), params=("generator_checkpoint", "size_style", "depth"))
+def style_pca(images, generator_checkpoint, size_style, depth, data_dir, device):
+    """Style vectors of the images and their projection on the first two PCs"""
+    from sklearn.decomposition import PCA
+    from train_gan import load_generator
+
+    generator = load_generator(
+        generator_checkpoint, size_style=size_style, depth=depth, device=device
+    )
+    with torch.inference_mode():
+        styles = generator.style_mapping(images["x"].to(device)).cpu()
+    styles_pca = PCA(n_components=2).fit_transform(styles.numpy())
+    return {"styles": styles, "styles_pca": torch.from_numpy(styles_pca)}
+
+
+class Pipeline:
+    """Runs stages and their dependencies, reusing cached results"""
+
+    def __init__(self, config, cache_dir="cache", data_dir="../data", device=None):
+        self.config = config
+        self.cache_dir = Path(cache_dir)
+        self.data_dir = data_dir
+        self.device = device or torch.device(
+            "cuda" if torch.cuda.is_available() else "cpu"
+        )
+        self._keys = {}
+        self._results = {}
+
+    def inputs(self, name):
+        inputs = STAGES[name][1]
+        return inputs(self.config) if callable(inputs) else inputs
+
+    def params(self, name):
+        params = STAGES[name][2]
+        return params(self.config) if callable(params) else params
+
+    def key(self, name):
+        """Cache key of stage `name`, given the configuration"""
+        if name not in self._keys:
+            h = hashlib.sha256(name.encode())
+            for param in self.params(name):
+                value = self.config[param]
+                if param.endswith("_checkpoint"):
+                    value = file_hash(value)
+                h.update(json.dumps([param, value]).encode())
+            for input_name in self.inputs(name):
+                h.update(self.key(input_name).encode())
+            self._keys[name] = h.hexdigest()[:16]
+        return self._keys[name]
+
+    def path(self, name):
+        return self.cache_dir / name / f"{self.key(name)}.pt"
+
+    def run(self, name):
+        """Result of stage `name`, computing it and its inputs if needed"""
+        if name in self._results:
+            return self._results[name]
+        path = self.path(name)
+        if path.exists():
+            print(f"{name}: using cached {path}")
+            result = torch.load(path, weights_only=True)
+        else:
+            func = STAGES[name][0]
+            inputs = {
+                input_name: self.run(input_name) for input_name in self.inputs(name)
+            }
+            print(f"{name}: computing")
+            result = func(
+                **inputs,
+                **{param: self.config[param] for param in self.params(name)},
+                data_dir=self.data_dir,
+                device=self.device,
+            )
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            torch.save(result, tmp_path)
+            os.replace(tmp_path, path)
+        self._results[name] = result
+        return result
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stages", nargs="+", choices=sorted(STAGES))
+    return add_pipeline_arguments(parser)
+
+
+if __name__ == "__main__":
+    args = get_arg_parser().parse_args()
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("stages", "cache_dir", "data_dir")
+    }
+    pipeline = Pipeline(config, cache_dir=args.cache_dir, data_dir=args.data_dir)
+    for name in args.stages:
+        pipeline.run(name)
+        print(f"{name}: {pipeline.path(name)}")
@@ -0,0 +1,33 @@
+"""
+Command line options of `pipeline.py`. They are kept apart from the pipeline,
+which imports torch, so that `cli.py` can offer them without slowing down its
+startup.
+"""
+
+
+def add_pipeline_arguments(parser):
+    """Add the configuration options of the pipeline to `parser`"""
+    parser.add_argument("--classifier-checkpoint", default="checkpoints/model.pth")
+    parser.add_argument(
+        "--generator-checkpoint", default="checkpoints/stargan/best.pth"
+    )
+    parser.add_argument("--split", default="test", choices=["train", "test"])
+    parser.add_argument("--num-images", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--baseline",
+        default="counterfactual",
+        choices=["zeros", "random", "blurred", "counterfactual"],
+    )
+    parser.add_argument(
+        "--counterfactual-method",
+        default="generator",
+        choices=["generator", "optimizer"],
+    )
+    parser.add_argument("--target-class", type=int, default=0)
+    parser.add_argument("--ig-tolerance", type=float, default=None)
+    parser.add_argument("--size-style", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--cache-dir", default="cache")
+    parser.add_argument("--data-dir", default="../data")
+    return parser
@@ -0,0 +1,174 @@
+"""
+Int8 quantization of `DenseModel` networks (the classifier or the
+discriminator) for CPU inference.
+
+Linear layers are quantized dynamically. Convolutions, if the model has any,
+are quantized statically after calibrating on a ColoredMNIST subset. The
+quantized model is only accepted if its predictions agree with the fp32 model
+on at least `min_agreement` of the test set.
+
+    python quantize.py checkpoints/model.pth --output checkpoints/model_int8.pt
+"""
+
+from classifier.model import DenseModel
+from classifier.data import ColoredMNIST
+from data_pipeline import make_dataloader
+from copy import deepcopy
+import argparse
+import time
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import Subset
+
+
+def _select_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError("No quantized engine is available on this machine")
+
+
+def quantize_static_convs(model, calibration_loader, num_batches=32):
+    """Statically quantize the convolutions of `model`, calibrating on a loader"""
+    from torch.ao.quantization import QConfigMapping, get_default_qconfig
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    qconfig = get_default_qconfig(_select_engine())
+    qconfig_mapping = QConfigMapping()
+    for conv in (nn.Conv1d, nn.Conv2d, nn.Conv3d):
+        qconfig_mapping.set_object_type(conv, qconfig)
+    example_x, _ = next(iter(calibration_loader))
+    prepared = prepare_fx(deepcopy(model).eval(), qconfig_mapping, (example_x,))
+    with torch.inference_mode():
+        for i, (x, _) in enumerate(calibration_loader):
+            if i == num_batches:
+                break
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def quantize(model, calibration_loader=None):
+    """
+    Quantize `model` for CPU inference. The convolutions are only quantized if
+    a `calibration_loader` is given.
+    """
+    _select_engine()
+    model = deepcopy(model).cpu().eval()
+    has_convs = any(
+        isinstance(m, (nn.Conv1d, nn.Conv2d, nn.Conv3d)) for m in model.modules()
+    )
+    if has_convs and calibration_loader is not None:
+        model = quantize_static_convs(model, calibration_loader)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+@torch.inference_mode()
+def compare_predictions(model, quantized_model, dataloader, num_classes=4):
+    """
+    Confusion matrices of both models against the labels, and the fraction of
+    images on which their predictions agree.
+    """
+    matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+    quantized_matrix = np.zeros_like(matrix)
+    agree = total = 0
+    for x, y in dataloader:
+        pred = model(x).argmax(dim=1)
+        quantized_pred = quantized_model(x).argmax(dim=1)
+        np.add.at(matrix, (y.numpy(), pred.numpy()), 1)
+        np.add.at(quantized_matrix, (y.numpy(), quantized_pred.numpy()), 1)
+        agree += (pred == quantized_pred).sum().item()
+        total += len(y)
+    return matrix, quantized_matrix, agree / total
+
+
+def quantize_with_gate(model, calibration_loader, test_loader, min_agreement=0.99):
+    """
+    Quantize `model` and check it against the fp32 model on `test_loader`.
+    Returns the quantized model, or `None` if the agreement is below
+    `min_agreement`, together with a report of the comparison.
+    """
+    model = deepcopy(model).cpu().eval()
+    quantized_model = quantize(model, calibration_loader)
+    matrix, quantized_matrix, agreement = compare_predictions(
+        model, quantized_model, test_loader
+    )
+    report = {
+        "agreement": agreement,
+        "confusion_matrix": matrix,
+        "quantized_confusion_matrix": quantized_matrix,
+        "accepted": agreement >= min_agreement,
+    }
+    if not report["accepted"]:
+        print(
+            f"Rejecting quantized model: agreement {agreement:.4f} < {min_agreement}"
+        )
+        return None, report
+    return quantized_model, report
+
+
+@torch.inference_mode()
+def benchmark(model, batch_size=256, num_batches=50, input_shape=(3, 28, 28)):
+    """Throughput of `model` on CPU, in images per second"""
+    x = torch.rand(batch_size, *input_shape)
+    for _ in range(5):
+        model(x)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        model(x)
+    return batch_size * num_batches / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", help="DenseModel state dict")
+    parser.add_argument(
+        "--key",
+        default=None,
+        help="Entry of the checkpoint holding the state dict, e.g. `discriminator`"
+        " in a GAN checkpoint",
+    )
+    parser.add_argument("--output", default="checkpoints/model_int8.pt")
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--num-classes", type=int, default=4)
+    parser.add_argument("--min-agreement", type=float, default=0.99)
+    parser.add_argument("--num-calibration-images", type=int, default=1024)
+    args = parser.parse_args()
+
+    model = DenseModel(input_shape=(3, 28, 28), num_classes=args.num_classes)
+    state_dict = torch.load(args.checkpoint, weights_only=True, map_location="cpu")
+    if args.key is not None:
+        state_dict = state_dict[args.key]
+    model.load_state_dict(state_dict)
+    model.eval()
+    train_data = ColoredMNIST(args.data_dir, download=True, train=True)
+    test_data = ColoredMNIST(args.data_dir, download=True, train=False)
+    calibration_indices = np.random.default_rng(0).choice(
+        len(train_data), args.num_calibration_images, replace=False
+    )
+    calibration_loader = make_dataloader(
+        Subset(train_data, calibration_indices), batch_size=32
+    )
+    test_loader = make_dataloader(test_data, batch_size=256)
+
+    quantized_model, report = quantize_with_gate(
+        model, calibration_loader, test_loader, min_agreement=args.min_agreement
+    )
+    print(f"Agreement with fp32: {report['agreement']:.4f}")
+    print("fp32 confusion matrix:")
+    print(report["confusion_matrix"])
+    print("int8 confusion matrix:")
+    print(report["quantized_confusion_matrix"])
+    if quantized_model is not None:
+        for batch_size in (1, 32, 256):
+            fp32 = benchmark(model, batch_size=batch_size)
+            int8 = benchmark(quantized_model, batch_size=batch_size)
+            print(
+                f"Batch size {batch_size}: fp32 {fp32:.0f} img/s, "
+                f"int8 {int8:.0f} img/s ({int8 / fp32:.2f}x)"
+            )
+        example_x = torch.rand(1, 3, 28, 28)
+        torch.jit.save(torch.jit.trace(quantized_model, example_x), args.output)
+        print(f"Saved quantized model to {args.output}")
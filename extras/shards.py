@@ -0,0 +1,108 @@
+"""
+On-disk layout of uint8 image shards, shared by the counterfactual exports
+and the synthetic datasets.
+
+An output directory holds a `manifest.json` describing the whole dataset,
+and for every shard `k` the images `shard_{k:05d}.npy` and the matching
+per-image manifest `shard_{k:05d}.npz`. The manifest of a shard is written
+last, so a shard without one is incomplete. Only NumPy is needed here, so
+worker processes don't have to import the models to write shards.
+"""
+
+import json
+import numpy as np
+import os
+from pathlib import Path
+
+
+def shard_paths(output_dir, shard):
+    """The image and manifest files of `shard`"""
+    output_dir = Path(output_dir)
+    return (
+        output_dir / f"shard_{shard:05d}.npy",
+        output_dir / f"shard_{shard:05d}.npz",
+    )
+
+
+def first_incomplete_shard(output_dir, num_shards):
+    """Index of the first shard without a manifest, `num_shards` if all are done"""
+    for shard in range(num_shards):
+        if not shard_paths(output_dir, shard)[1].exists():
+            return shard
+    return num_shards
+
+
+def write_shard(output_dir, shard, images, manifest):
+    """
+    Write the uint8 `images` and the `manifest` arrays of `shard`. Both are
+    written to temporary files first, and the manifest is moved in place last.
+    """
+    image_path, manifest_path = shard_paths(output_dir, shard)
+    tmp_images = image_path.with_suffix(".tmp.npy")
+    tmp_manifest = manifest_path.with_suffix(".tmp.npz")
+    np.save(tmp_images, images)
+    np.savez(tmp_manifest, **manifest)
+    os.replace(tmp_images, image_path)
+    os.replace(tmp_manifest, manifest_path)
+
+
+def write_manifest(output_dir, info, unchecked=()):
+    """
+    Write the `info` of an export to `manifest.json`. If the export is being
+    resumed, check instead that it has the same `info`, except for the keys
+    in `unchecked`: shards written with other settings would not line up with
+    the new ones.
+    """
+    path = Path(output_dir) / "manifest.json"
+    info = json.loads(json.dumps(info))
+    if path.exists():
+        with open(path, "r") as f:
+            existing = json.load(f)
+        changed = sorted(
+            key
+            for key in set(existing) | set(info)
+            if key not in unchecked and existing.get(key) != info.get(key)
+        )
+        if changed:
+            raise ValueError(
+                f"Cannot resume the export in {output_dir}, it was started with "
+                f"different {', '.join(changed)}; use a new output directory"
+            )
+        return
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(info, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class ShardReader:
+    """
+    Base class of the datasets reading shards back. `info` is the content of
+    `manifest.json` and `manifest` the concatenated manifests of all complete
+    shards. Shards are memory-mapped on first access.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        with open(self.output_dir / "manifest.json", "r") as f:
+            self.info = json.load(f)
+        self.shard_size = self.info["shard_size"]
+        manifests = []
+        for shard in range(self.info["num_shards"]):
+            manifest_path = shard_paths(self.output_dir, shard)[1]
+            if not manifest_path.exists():
+                break
+            with np.load(manifest_path) as manifest:
+                manifests.append(dict(manifest))
+        if not manifests:
+            raise FileNotFoundError(f"No complete shards in {self.output_dir}")
+        self.manifest = {
+            key: np.concatenate([m[key] for m in manifests]) for key in manifests[0]
+        }
+        self._shards = {}
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            image_path = shard_paths(self.output_dir, shard)[0]
+            self._shards[shard] = np.load(image_path, mmap_mode="r")
+        return self._shards[shard]
@@ -0,0 +1,206 @@
+"""
+Run a hyperparameter sweep of GAN or classifier trainings in parallel.
+
+The sweep is described by a JSON file, for example:
+
+    {
+        "kind": "gan",
+        "grid": {"size_style": [3, 8], "depth": [2, 3], "lr_g": [1e-4, 1e-3]},
+        "fixed": {"total_epochs": 14, "data_dir": "../data"}
+    }
+
+Every combination of the `grid` values is trained in its own directory under
+`--output`, and its final metric is recorded in a SQLite database, together
+with the metric's name and whether higher or lower is better. Runs that
+already finished are skipped, so an interrupted sweep can simply be restarted;
+unfinished GAN runs resume from their last checkpoint.
+
+    python sweep.py sweep.json --workers 4 --threads 2
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from utils import available_cores
+
+# The metric returned by each kind of run, and whether higher or lower is better
+METRICS = {
+    "gan": ("best_flip_rate", "higher"),
+    "classifier": ("final_loss", "lower"),
+}
+
+
+def grid_configs(grid, fixed=None):
+    """All combinations of the values in `grid`, each merged with `fixed`"""
+    keys = sorted(grid)
+    for values in itertools.product(*(grid[k] for k in keys)):
+        yield {**(fixed or {}), **dict(zip(keys, values))}
+
+
+def run_id(kind, config):
+    """A stable identifier for a run, so that it can be found again on resume"""
+    key = json.dumps({"kind": kind, "config": config}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def open_database(path):
+    db = sqlite3.connect(path)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            kind TEXT,
+            config TEXT,
+            status TEXT,
+            metric REAL,
+            metric_name TEXT,
+            metric_direction TEXT,
+            started REAL,
+            finished REAL,
+            error TEXT
+        )
+        """
+    )
+    # Databases from before the metric name and direction were recorded
+    columns = {row[1] for row in db.execute("PRAGMA table_info(runs)")}
+    for column in ("metric_name", "metric_direction"):
+        if column not in columns:
+            db.execute(f"ALTER TABLE runs ADD COLUMN {column} TEXT")
+    db.commit()
+    return db
+
+
+def _init_worker(core_sets, threads):
+    """Pin this worker to its own cores and limit its intra-op threads"""
+    cores = core_sets.get()
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    # OpenMP reads this when torch is first imported
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    import torch
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+
+def _run(kind, config, run_dir):
+    """
+    Train a single configuration. Returns its metric, see `METRICS`: the best
+    flip rate for GANs, and the final training loss for classifiers. The
+    threads were set by `_init_worker`, so they are not autotuned.
+    """
+    if kind == "gan":
+        from train_gan import train_gan
+
+        return train_gan(save_dir=run_dir, num_workers=0, autotune=False, **config)
+    if kind == "classifier":
+        from train_classifier import train_classifier
+
+        return train_classifier(
+            base_dir=run_dir, num_workers=0, autotune=False, **config
+        )
+    raise ValueError(f"Unknown sweep kind {kind}")
+
+
+def run_sweep(spec, output, db_path, workers=2, threads=1):
+    """
+    Train every configuration of `spec` that has not finished yet, using a
+    pool of `workers` processes with `threads` intra-op threads each.
+    """
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    db = open_database(db_path)
+    kind = spec["kind"]
+    if kind not in METRICS:
+        raise ValueError(f"Unknown sweep kind {kind}")
+    metric_name, metric_direction = METRICS[kind]
+    done = {
+        row[0] for row in db.execute("SELECT run_id FROM runs WHERE status = 'done'")
+    }
+    pending = {}
+    for config in grid_configs(spec["grid"], spec.get("fixed")):
+        rid = run_id(kind, config)
+        if rid not in done:
+            pending[rid] = config
+    print(f"{len(done)} runs already done, {len(pending)} to go")
+    if not pending:
+        db.close()
+        return
+
+    # Split the available cores into disjoint sets, one per worker
+    context = multiprocessing.get_context("spawn")
+    core_sets = context.Queue()
+    cores = available_cores()
+    for i in range(workers):
+        core_sets.put(cores[i * threads : (i + 1) * threads] or None)
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(core_sets, threads),
+    ) as pool:
+        futures = {}
+        for rid, config in pending.items():
+            db.execute(
+                "INSERT OR REPLACE INTO runs (run_id, kind, config, status,"
+                " metric_name, metric_direction, started)"
+                " VALUES (?, ?, ?, 'running', ?, ?, ?)",
+                (
+                    rid,
+                    kind,
+                    json.dumps(config, sort_keys=True),
+                    metric_name,
+                    metric_direction,
+                    time.time(),
+                ),
+            )
+            futures[pool.submit(_run, kind, config, str(output / rid))] = rid
+        db.commit()
+        for future in as_completed(futures):
+            rid = futures[future]
+            try:
+                metric = future.result()
+                if metric is None or not math.isfinite(metric):
+                    # e.g. a GAN run that stopped before its first evaluation
+                    raise ValueError(f"The run produced no {metric_name}")
+                db.execute(
+                    "UPDATE runs SET status = 'done', metric = ?, finished = ?"
+                    " WHERE run_id = ?",
+                    (metric, time.time(), rid),
+                )
+                print(f"Run {rid} finished with {metric_name} {metric}")
+            except Exception:
+                error = traceback.format_exc()
+                db.execute(
+                    "UPDATE runs SET status = 'failed', error = ?, finished = ?"
+                    " WHERE run_id = ?",
+                    (error, time.time(), rid),
+                )
+                print(f"Run {rid} failed:\n{error}")
+            db.commit()
+    db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", help="JSON file describing the sweep")
+    parser.add_argument("--output", default="checkpoints/sweep")
+    parser.add_argument("--db", default="checkpoints/sweep/results.sqlite")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.spec, "r") as f:
+        spec = json.load(f)
+    Path(args.db).parent.mkdir(parents=True, exist_ok=True)
+    run_sweep(spec, args.output, args.db, workers=args.workers, threads=args.threads)
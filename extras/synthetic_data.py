@@ -0,0 +1,261 @@
+"""
+Generate arbitrarily large ColoredMNIST-style datasets, for load and scaling
+tests of training, attribution and export.
+
+The coloring rule is the same as `classifier.data.ColoredMNIST`: the class of
+an image picks one of the `spring`, `summer`, `autumn` and `winter`
+colormaps, and the grayscale digit is multiplied by the color at a random
+position along it. All four colormaps are linear in that position, so the
+colors of a whole batch are computed with two table lookups. Digits are
+drawn with replacement from MNIST and can be placed, several per image, on
+larger canvases, with random brightness and noise.
+
+The output uses the shard layout of `export_counterfactuals.py`: uint8
+`shard_{k:05d}.npy` arrays of shape `(shard_size, 3, canvas, canvas)` and
+`shard_{k:05d}.npz` manifests with the class, digit, MNIST index and color
+position of every image. Every shard has its own seed, so shards can be
+generated in parallel and an interrupted run only generates the missing
+shards, provided it uses the same options.
+
+    python synthetic_data.py synthetic --num-images 10000000 --workers 8
+"""
+
+from shards import ShardReader, shard_paths, write_manifest
+from pathlib import Path
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+CLASSES = ("spring", "summer", "autumn", "winter")
+# The RGB color of each colormap at position t is OFFSET + SLOPE * t
+OFFSET = np.array(
+    [[1.0, 0.0, 1.0], [0.0, 0.5, 0.4], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]],
+    dtype=np.float32,
+)
+SLOPE = np.array(
+    [[0.0, 1.0, -1.0], [1.0, 0.5, 0.0], [0.0, 1.0, 0.0], [0.0, 1.0, -0.5]],
+    dtype=np.float32,
+)
+
+
+def load_digits(data_dir="../data", train=True):
+    """The grayscale MNIST digits as a uint8 `(N, 28, 28)` array, and labels"""
+    from torchvision.datasets import MNIST
+
+    mnist = MNIST(data_dir, train=train, download=True)
+    return mnist.data.numpy(), mnist.targets.numpy()
+
+
+def colors(conditions, positions):
+    """RGB colors of shape `(B, 3)` for the classes and colormap positions"""
+    return OFFSET[conditions] + SLOPE[conditions] * positions[:, None]
+
+
+def place_digits(digits, canvas_size, rng):
+    """
+    Paste every digit of the `(B, k, 28, 28)` array `digits` at a random
+    position of its own `canvas_size` canvas, overlapping digits are merged
+    with a maximum. Returns a `(B, canvas_size, canvas_size)` array.
+    """
+    batch_size, per_canvas, height, width = digits.shape
+    canvas = np.zeros((batch_size, canvas_size, canvas_size), dtype=digits.dtype)
+    index = np.arange(batch_size)[:, None, None]
+    for k in range(per_canvas):
+        top = rng.integers(0, canvas_size - height + 1, size=batch_size)
+        left = rng.integers(0, canvas_size - width + 1, size=batch_size)
+        rows = top[:, None, None] + np.arange(height)[None, :, None]
+        cols = left[:, None, None] + np.arange(width)[None, None, :]
+        canvas[index, rows, cols] = np.maximum(
+            canvas[index, rows, cols], digits[:, k]
+        )
+    return canvas
+
+
+def generate_batch(
+    digits,
+    labels,
+    batch_size,
+    rng,
+    canvas_size=28,
+    digits_per_canvas=1,
+    augment=False,
+):
+    """
+    Generate `batch_size` colored images from the MNIST `digits`.
+
+    Returns the uint8 images of shape `(batch_size, 3, canvas_size,
+    canvas_size)` and a manifest of the `condition` (class), `digit` label
+    and MNIST `source_index` (of the first digit) and the colormap `position`
+    of every image.
+    """
+    source_index = rng.integers(0, len(digits), size=(batch_size, digits_per_canvas))
+    gray = digits[source_index]
+    if canvas_size != 28 or digits_per_canvas > 1:
+        gray = place_digits(gray, canvas_size, rng)
+    else:
+        gray = gray[:, 0]
+    gray = gray.astype(np.float32)
+    if augment:
+        gray *= rng.uniform(0.6, 1.0, size=(batch_size, 1, 1)).astype(np.float32)
+        gray += 8 * rng.standard_normal(size=gray.shape, dtype=np.float32)
+        np.clip(gray, 0, 255, out=gray)
+    conditions = rng.integers(0, len(CLASSES), size=batch_size)
+    positions = rng.random(batch_size, dtype=np.float32)
+    color = colors(conditions, positions)
+    images = gray[:, None] * color[:, :, None, None]
+    images = (images + 0.5).astype(np.uint8)
+    manifest = {
+        "condition": conditions,
+        "digit": labels[source_index[:, 0]],
+        "source_index": source_index[:, 0],
+        "position": positions,
+    }
+    return images, manifest
+
+
+def _generate_shard(
+    output_dir, shard, shard_size, seed, digits, labels, options, chunk_size=8192
+):
+    """
+    Generate one shard chunk by chunk into a memory-mapped file, so memory use
+    doesn't depend on the shard size. The manifest is moved in place last.
+    """
+    rng = np.random.default_rng([seed, shard])
+    image_path, manifest_path = shard_paths(output_dir, shard)
+    tmp_images = image_path.with_suffix(".tmp.npy")
+    canvas_size = options["canvas_size"]
+    images = np.lib.format.open_memmap(
+        tmp_images,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(shard_size, 3, canvas_size, canvas_size),
+    )
+    manifests = []
+    for start in range(0, shard_size, chunk_size):
+        size = min(chunk_size, shard_size - start)
+        chunk, manifest = generate_batch(digits, labels, size, rng, **options)
+        images[start : start + size] = chunk
+        manifests.append(manifest)
+    images.flush()
+    del images
+    tmp_manifest = manifest_path.with_suffix(".tmp.npz")
+    np.savez(
+        tmp_manifest,
+        **{key: np.concatenate([m[key] for m in manifests]) for key in manifests[0]},
+    )
+    os.replace(tmp_images, image_path)
+    os.replace(tmp_manifest, manifest_path)
+    return shard
+
+
+def _init_worker(data_dir):
+    global _digits, _labels
+    _digits, _labels = load_digits(data_dir)
+
+
+def _worker(args):
+    return _generate_shard(*args[:4], _digits, _labels, args[4])
+
+
+def generate(
+    output_dir,
+    num_images,
+    shard_size=100_000,
+    canvas_size=28,
+    digits_per_canvas=1,
+    augment=False,
+    seed=0,
+    workers=1,
+    data_dir="../data",
+):
+    """
+    Write `num_images` synthetic images to `output_dir`, in shards of
+    `shard_size` (the last one may be smaller), using `workers` processes.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    num_shards = -(-num_images // shard_size)
+    options = {
+        "canvas_size": canvas_size,
+        "digits_per_canvas": digits_per_canvas,
+        "augment": augment,
+    }
+    write_manifest(
+        output_dir,
+        {
+            "num_images": num_images,
+            "num_shards": num_shards,
+            "shard_size": shard_size,
+            "num_classes": len(CLASSES),
+            "seed": seed,
+            **options,
+        },
+    )
+    todo = [
+        (output_dir, shard, min(shard_size, num_images - shard * shard_size), seed)
+        for shard in range(num_shards)
+        if not shard_paths(output_dir, shard)[1].exists()
+    ]
+    if workers <= 1:
+        digits, labels = load_digits(data_dir)
+        for args in tqdm(todo, desc="Shards"):
+            _generate_shard(*args, digits, labels, options)
+        return
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_worker, initargs=(data_dir,)) as pool:
+        for _ in tqdm(
+            pool.imap_unordered(_worker, [(*args, options) for args in todo]),
+            total=len(todo),
+            desc="Shards",
+        ):
+            pass
+
+
+class SyntheticColoredMNIST(ShardReader, Dataset):
+    """
+    Read back a generated dataset. Items are `(image, condition)`, like
+    `ColoredMNIST`, and shards are memory-mapped on first access.
+    """
+
+    def __init__(self, output_dir):
+        super().__init__(output_dir)
+        self.classes = list(CLASSES)
+        self.conditions = self.manifest["condition"]
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def __getitem__(self, index):
+        shard, offset = divmod(index, self.shard_size)
+        x = torch.from_numpy(np.array(self._shard(shard)[offset]))
+        return x.float() / 255, int(self.conditions[index])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir")
+    parser.add_argument("--num-images", type=int, default=1_000_000)
+    parser.add_argument("--shard-size", type=int, default=100_000)
+    parser.add_argument("--canvas-size", type=int, default=28)
+    parser.add_argument("--digits-per-canvas", type=int, default=1)
+    parser.add_argument("--augment", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--data-dir", default="../data")
+    args = parser.parse_args()
+
+    generate(
+        args.output_dir,
+        args.num_images,
+        shard_size=args.shard_size,
+        canvas_size=args.canvas_size,
+        digits_per_canvas=args.digits_per_canvas,
+        augment=args.augment,
+        seed=args.seed,
+        workers=args.workers,
+        data_dir=args.data_dir,
+    )
@@ -0,0 +1,205 @@
+"""
+Counterfactual inference on images larger than the 28x28 inputs the
+`Generator` and `DenseModel` were trained on.
+
+Large images are split into overlapping tiles, the tiles of all images are
+translated in batches with a single shared style vector, and the outputs are
+blended back together, weighting each tile with a window that falls off
+towards its edges. Inputs are read from memory-mapped `.npy` files and the
+output is written to one, so memory use only depends on the batch size.
+
+    python tiled_inference.py checkpoints/stargan/best.pth fields.npy out.npy \\
+        --style-class 2
+"""
+
+from gan_metrics import class_prototypes
+from train_gan import load_generator
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def tile_starts(size, tile_size=28, stride=14):
+    """Start of the tiles along one axis, the last tile ends at the edge"""
+    if size < tile_size:
+        raise ValueError(f"Images of size {size} are smaller than the tiles")
+    if size == tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size + 1, stride))
+    if starts[-1] != size - tile_size:
+        starts.append(size - tile_size)
+    return starts
+
+
+def tile_positions(height, width, tile_size=28, stride=14):
+    """Top-left corners of the tiles covering an image"""
+    return [
+        (i, j)
+        for i in tile_starts(height, tile_size, stride)
+        for j in tile_starts(width, tile_size, stride)
+    ]
+
+
+def blending_window(tile_size=28):
+    """Triangular 1D window, so overlapping tiles fade into each other"""
+    ramp = np.minimum(np.arange(1, tile_size + 1), np.arange(tile_size, 0, -1))
+    return (ramp / ramp.max()).astype(np.float32)
+
+
+def blending_weights(size, tile_size=28, stride=14):
+    """
+    Total window weight at every position along one axis. The 2D window is
+    separable and the tiles lie on a grid, so the 2D weights are the outer
+    product of the weights along both axes.
+    """
+    window = blending_window(tile_size)
+    weights = np.zeros(size, dtype=np.float32)
+    for start in tile_starts(size, tile_size, stride):
+        weights[start : start + tile_size] += window
+    return weights
+
+
+def iterate_tiles(images, tile_size=28, stride=14):
+    """
+    Yield `(image_index, i, j, tile)` for every tile of every image in the
+    `(N, C, H, W)` array `images`, which may be memory-mapped.
+    """
+    height, width = images.shape[2:]
+    positions = tile_positions(height, width, tile_size, stride)
+    for index in range(len(images)):
+        for i, j in positions:
+            tile = np.asarray(images[index, :, i : i + tile_size, j : j + tile_size])
+            yield index, i, j, tile
+
+
+@torch.inference_mode()
+def translate_tiled(
+    generator,
+    images,
+    style,
+    output,
+    tile_size=28,
+    stride=14,
+    batch_size=512,
+    device="cpu",
+):
+    """
+    Translate every image of `images` using the `style` image for all tiles,
+    writing the blended result to `output`.
+
+    images: np.ndarray
+        Array of shape `(N, 3, H, W)` with values in [0, 1], typically opened
+        with `np.load(..., mmap_mode="r")`.
+    style: torch.Tensor
+        A single `(3, 28, 28)` style image, the input size of the style
+        mapping, whatever the `tile_size`.
+    output: np.ndarray
+        Array of the same shape as `images`, typically created with
+        `np.lib.format.open_memmap`.
+    """
+    window = blending_window(tile_size)
+    height, width = images.shape[2:]
+    weights_y = blending_weights(height, tile_size, stride)
+    weights_x = blending_weights(width, tile_size, stride)
+    # The style vector is the same for every tile, so it is only computed once
+    style_vector = generator.style_mapping(style.unsqueeze(0).to(device))
+    style_vector = style_vector[..., None, None].expand(-1, -1, tile_size, tile_size)
+
+    def run(batch):
+        x = torch.from_numpy(np.stack([tile for _, _, _, tile in batch]))
+        x = x.float().to(device)
+        x = torch.cat([x, style_vector.expand(len(x), -1, -1, -1)], dim=1)
+        translated = generator.generator(x).cpu().numpy()
+        for (index, i, j, _), tile in zip(batch, translated):
+            # Normalizing each tile by the total weight makes the sum a blend
+            weight = np.outer(
+                window / weights_y[i : i + tile_size],
+                window / weights_x[j : j + tile_size],
+            )
+            output[index, :, i : i + tile_size, j : j + tile_size] += tile * weight
+
+    output[:] = 0
+    num_tiles = len(images) * len(tile_positions(height, width, tile_size, stride))
+    batch = []
+    for item in tqdm(
+        iterate_tiles(images, tile_size, stride), total=num_tiles, desc="Tiles"
+    ):
+        batch.append(item)
+        if len(batch) == batch_size:
+            run(batch)
+            batch = []
+    if batch:
+        run(batch)
+    return output
+
+
+@torch.inference_mode()
+def classify_tiled(
+    classifier, images, tile_size=28, stride=28, batch_size=512, device="cpu"
+):
+    """
+    Classify every tile of every image on `device`. Returns the mean softmax
+    over tiles for each image, of shape `(N, num_classes)`, on the CPU.
+    """
+    classifier = classifier.to(device)
+    totals, counts = {}, {}
+    batch = []
+
+    def run(batch):
+        x = torch.from_numpy(np.stack([tile for _, _, _, tile in batch]))
+        x = x.float().to(device)
+        probabilities = torch.softmax(classifier(x), dim=1).cpu()
+        for (index, _, _, _), p in zip(batch, probabilities):
+            totals[index] = totals.get(index, 0) + p
+            counts[index] = counts.get(index, 0) + 1
+
+    for item in iterate_tiles(images, tile_size, stride):
+        batch.append(item)
+        if len(batch) == batch_size:
+            run(batch)
+            batch = []
+    if batch:
+        run(batch)
+    return torch.stack([totals[i] / counts[i] for i in range(len(images))])
+
+
+if __name__ == "__main__":
+    from classifier.data import ColoredMNIST
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("generator_checkpoint")
+    parser.add_argument("input", help=".npy file of shape (N, 3, H, W) in [0, 1]")
+    parser.add_argument("output", help=".npy file to write the result to")
+    parser.add_argument("--style-class", type=int, required=True)
+    parser.add_argument("--data-dir", default="../data")
+    parser.add_argument("--size-style", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--tile-size", type=int, default=28)
+    parser.add_argument("--stride", type=int, default=14)
+    parser.add_argument("--batch-size", type=int, default=512)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = load_generator(
+        args.generator_checkpoint,
+        size_style=args.size_style,
+        depth=args.depth,
+        device=device,
+    )
+    prototypes = class_prototypes(ColoredMNIST(args.data_dir, train=False))
+    images = np.load(args.input, mmap_mode="r")
+    output = np.lib.format.open_memmap(
+        args.output, mode="w+", dtype=np.float32, shape=images.shape
+    )
+    translate_tiled(
+        generator,
+        images,
+        prototypes[args.style_class],
+        output,
+        tile_size=args.tile_size,
+        stride=args.stride,
+        batch_size=args.batch_size,
+        device=device,
+    )
+    output.flush()
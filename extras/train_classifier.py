@@ -4,33 +4,41 @@ This script was used to train the pre-trained model weights that were given as a
 
 from classifier.model import DenseModel
 from classifier.data import ColoredMNIST
+from autotune import get_config
+from data_pipeline import make_dataloader, prefetch
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from pathlib import Path
 
 
-def train_classifier(base_dir, epochs=10):
+def train_classifier(
+    base_dir, epochs=10, lr=1e-4, data_dir=None, num_workers=None, autotune=True
+):
     checkpoint_dir = Path(base_dir) / "checkpoints"
-    checkpoint_dir.mkdir(exist_ok=True)
-    data_dir = Path(base_dir) / "data"
-    data_dir.mkdir(exist_ok=True)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    data_dir = Path(data_dir or Path(base_dir) / "data")
+    data_dir.mkdir(parents=True, exist_ok=True)
     #
     model = DenseModel((28, 28, 3), 4)
     data = ColoredMNIST(data_dir, download=True, train=True)
-    dataloader = DataLoader(data, batch_size=32, shuffle=True, pin_memory=True)
-
-    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
-    loss_fn = torch.nn.CrossEntropyLoss()
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if device.type == "cpu" and autotune:
+        # The batch size is a training hyperparameter, only the threads are tuned
+        get_config("dense_model")
+    dataloader = make_dataloader(
+        data, batch_size=32, shuffle=True, device=device, num_workers=num_workers
+    )
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    loss_fn = torch.nn.CrossEntropyLoss()
     model.to(device)
 
     losses = []
     for epoch in range(epochs):
-        for x, y in tqdm(dataloader, desc=f"Epoch {epoch}"):
+        for x, y in tqdm(prefetch(dataloader, device), desc=f"Epoch {epoch}"):
             optimizer.zero_grad()
-            y_pred = model(x.to(device))
-            loss = loss_fn(y_pred, y.to(device))
+            y_pred = model(x)
+            loss = loss_fn(y_pred, y)
             loss.backward()
             optimizer.step()
         print(f"Epoch {epoch}: Loss = {loss.item()}")
@@ -40,6 +48,7 @@ def train_classifier(base_dir, epochs=10):
 
     with open(checkpoint_dir / "losses.txt", "w") as f:
         f.write("\n".join(str(l) for l in losses))
+    return losses[-1]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+"""
+Train an ensemble of `DenseModel` classifiers with different seeds in a single
+batched pass, to check how stable the learned color rule is.
+
+The parameters of all models are stacked with `torch.func.stack_module_state`
+and the models are evaluated together with `vmap`. Every model sees its own
+shuffling of the training data.
+"""
+
+from classifier.model import DenseModel
+from classifier.data import ColoredMNIST
+from data_pipeline import make_dataloader, prefetch
+from validate_classifier import confusion_matrix
+from copy import deepcopy
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+from torch.utils.data import Sampler
+from tqdm import tqdm
+from pathlib import Path
+
+
+class EnsembleBatchSampler(Sampler):
+    """
+    Yields batches of `num_models * batch_size` indices. The `k`-th block of
+    `batch_size` indices comes from the `k`-th model's own shuffling of the
+    dataset. Incomplete batches are dropped.
+    """
+
+    def __init__(self, num_samples, num_models, batch_size, seed=0):
+        self.num_samples = num_samples
+        self.num_models = num_models
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return self.num_samples // self.batch_size
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        permutations = torch.stack(
+            [
+                torch.randperm(self.num_samples, generator=generator)
+                for _ in range(self.num_models)
+            ]
+        )
+        for i in range(len(self)):
+            batch = permutations[:, i * self.batch_size : (i + 1) * self.batch_size]
+            yield batch.reshape(-1).tolist()
+
+
+def make_ensemble(num_models, device, seed=0):
+    """
+    Create `num_models` differently seeded classifiers, returns their stacked
+    parameters and buffers and a stateless copy of the model to call them with.
+    """
+    models = []
+    for k in range(num_models):
+        torch.manual_seed(seed + k)
+        models.append(DenseModel((28, 28, 3), 4).to(device))
+    params, buffers = stack_module_state(models)
+    base_model = deepcopy(models[0]).to("meta")
+    return params, buffers, base_model
+
+
+def ensemble_forward(base_model, params, buffers, x, shared_input=False):
+    """
+    Run all models of the ensemble. `x` has shape `(num_models, batch, ...)`,
+    or `(batch, ...)` if `shared_input` is set and every model gets the same
+    batch. Returns logits of shape `(num_models, batch, num_classes)`.
+    """
+
+    def call(params, buffers, x):
+        return functional_call(base_model, (params, buffers), (x,))
+
+    in_dims = (0, 0, None if shared_input else 0)
+    return vmap(call, in_dims=in_dims, randomness="different")(params, buffers, x)
+
+
+def train_ensemble(base_dir, num_models=5, epochs=10, lr=1e-4, seed=0):
+    """
+    Train `num_models` classifiers together. Each model's weights are stored
+    in `checkpoints/ensemble/model_{k}.pth` in the same format as
+    `train_classifier.py`, so they can be loaded into a `DenseModel`.
+    """
+    checkpoint_dir = Path(base_dir) / "checkpoints" / "ensemble"
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    data_dir = Path(base_dir) / "data"
+    data_dir.mkdir(exist_ok=True)
+    #
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    params, buffers, base_model = make_ensemble(num_models, device, seed=seed)
+    data = ColoredMNIST(data_dir, download=True, train=True)
+    sampler = EnsembleBatchSampler(len(data), num_models, batch_size=32, seed=seed)
+    dataloader = make_dataloader(data, device=device, batch_sampler=sampler)
+
+    optimizer = torch.optim.Adam(params.values(), lr=lr)
+    loss_fn = torch.nn.CrossEntropyLoss(reduction="none")
+
+    losses = []
+    base_model.train()
+    for epoch in range(epochs):
+        for x, y in tqdm(prefetch(dataloader, device), desc=f"Epoch {epoch}"):
+            x = x.view(num_models, -1, *x.shape[1:])
+            y = y.view(num_models, -1)
+            optimizer.zero_grad()
+            y_pred = ensemble_forward(base_model, params, buffers, x)
+            # Per-model mean loss, summed so that the models don't interact
+            loss = loss_fn(y_pred.flatten(0, 1), y.flatten()).view(num_models, -1)
+            loss = loss.mean(dim=1)
+            loss.sum().backward()
+            optimizer.step()
+        print(f"Epoch {epoch}: Loss = {loss.tolist()}")
+        losses.append(loss.tolist())
+        for k in range(num_models):
+            state_dict = {
+                name: tensor[k].detach().clone()
+                for name, tensor in {**params, **buffers}.items()
+            }
+            torch.save(state_dict, checkpoint_dir / f"model_{k}.pth")
+
+    np.savetxt(checkpoint_dir / "losses.txt", np.array(losses))
+    return params, buffers, base_model
+
+
+@torch.inference_mode()
+def validate_ensemble(params, buffers, base_model, checkpoint_dir, data_dir="../data"):
+    """
+    Compute one confusion matrix per model on the test set, in a single pass.
+    Matrices are saved as `confusion_matrix_{k}.txt` in `checkpoint_dir`.
+    """
+    data = ColoredMNIST(data_dir, download=False, train=False)
+    device = next(iter(params.values())).device
+    dataloader = make_dataloader(data, batch_size=256, shuffle=False, device=device)
+
+    base_model.eval()
+    labels = []
+    predictions = []
+    for x, y in tqdm(prefetch(dataloader, device), desc="Validation"):
+        pred = ensemble_forward(base_model, params, buffers, x, shared_input=True)
+        labels.append(y.cpu().numpy())
+        predictions.append(pred.argmax(dim=2).cpu().numpy())
+    labels = np.concatenate(labels)
+    predictions = np.concatenate(predictions, axis=1)
+
+    matrices = []
+    for k, model_predictions in enumerate(predictions):
+        matrix = confusion_matrix(labels, model_predictions)
+        np.savetxt(Path(checkpoint_dir) / f"confusion_matrix_{k}.txt", matrix, fmt="%d")
+        matrices.append(matrix)
+    return np.stack(matrices)
+
+
+if __name__ == "__main__":
+    this_dir = Path(__file__).parent
+    params, buffers, base_model = train_ensemble(base_dir=this_dir, num_models=5)
+    validate_ensemble(
+        params,
+        buffers,
+        base_model,
+        checkpoint_dir=this_dir / "checkpoints" / "ensemble",
+        data_dir=this_dir / "data",
+    )
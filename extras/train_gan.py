@@ -3,10 +3,16 @@ from classifier.model import DenseModel
 from classifier.data import ColoredMNIST
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
+from autotune import get_config
+from data_pipeline import make_dataloader, prefetch
+from gan_metrics import class_prototypes, flip_rate, held_out_subset, load_classifier
 from tqdm import tqdm
 from copy import deepcopy
+from functools import partial
+import torch.utils.checkpoint
 import json
+import os
+import time
 from pathlib import Path
 
 
@@ -31,6 +37,31 @@ class Generator(nn.Module):
         return self.generator(x)
 
 
+def load_generator(checkpoint, size_style=8, depth=2, device="cpu", mmap=False):
+    """
+    Load a `Generator` from a `checkpoint_{epoch}.pth` or `best.pth` file.
+    The generator is put in evaluation mode and its gradients are disabled.
+    With `mmap`, the file is memory-mapped instead of read into memory, so
+    the optimizer and discriminator states in it are never loaded.
+    """
+    weights = torch.load(
+        checkpoint, map_location=device, weights_only=True, mmap=mmap
+    )
+    unet = UNet(
+        depth=depth,
+        in_channels=3 + size_style,
+        out_channels=3,
+        final_activation=nn.Sigmoid(),
+    )
+    style_mapping = DenseModel(input_shape=(3, 28, 28), num_classes=size_style)
+    unet.load_state_dict(weights["unet"])
+    style_mapping.load_state_dict(weights["style_mapping"])
+    generator = Generator(unet, style_mapping=style_mapping).to(device)
+    generator.eval()
+    set_requires_grad(generator, False)
+    return generator
+
+
 def set_requires_grad(module, value=True):
     """Sets `requires_grad` on a `module`'s parameters to `value`"""
     for param in module.parameters():
@@ -51,42 +82,290 @@ def copy_parameters(source_model, target_model):
         target_param.data.copy_(param.data)
 
 
-if __name__ == "__main__":
-    save_dir = Path("checkpoints/stargan")
+class EarlyStopping:
+    """
+    Keeps track of a validation metric (higher is better) and signals when it
+    has not improved by at least `min_delta` for `patience` evaluations.
+    """
+
+    def __init__(self, patience=5, min_delta=1e-3):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = float("-inf")
+        self.num_bad_evaluations = 0
+
+    def step(self, metric):
+        """Record `metric`, returns True if it is the best value so far"""
+        if metric > self.best + self.min_delta:
+            self.best = metric
+            self.num_bad_evaluations = 0
+            return True
+        self.num_bad_evaluations += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.num_bad_evaluations >= self.patience
+
+    def state_dict(self):
+        return {"best": self.best, "num_bad_evaluations": self.num_bad_evaluations}
+
+    def load_state_dict(self, state):
+        self.best = state["best"]
+        self.num_bad_evaluations = state["num_bad_evaluations"]
+
+
+def train_step(
+    generator, discriminator, x, y, cycle_loss_fn, class_loss_fn, loss_scale=1.0
+):
+    """
+    Compute the generator and discriminator losses of one (micro-)batch and
+    accumulate their gradients, scaled by `loss_scale`. The optimizers are not
+    stepped, so that gradients can be accumulated over several micro-batches.
+
+    Returns the detached cycle, adversarial and discriminator losses.
+    """
+    # get the target y by shuffling the classes
+    # get the style sources by random sampling
+    random_index = torch.randperm(len(y))
+    x_style = x[random_index].clone()
+    y_target = y[random_index].clone()
+
+    # Set training gradients correctly
+    set_requires_grad(generator, True)
+    set_requires_grad(discriminator, False)
+    # Get the fake image
+    x_fake = generator(x, x_style)
+    # Try to cycle back
+    x_cycled = generator(x_fake, x)
+    # Discriminate
+    discriminator_x_fake = discriminator(x_fake)
+    # Losses to  train the generator
+
+    # 1. make sure the image can be reconstructed
+    cycle_loss = cycle_loss_fn(x, x_cycled)
+    # 2. make sure the discriminator is fooled
+    adv_loss = class_loss_fn(discriminator_x_fake, y_target)
+
+    # Generator gradients
+    ((cycle_loss + adv_loss) * loss_scale).backward()
+
+    # Set training gradients correctly
+    set_requires_grad(generator, False)
+    set_requires_grad(discriminator, True)
+    # Discriminate
+    discriminator_x = discriminator(x)
+    discriminator_x_fake = discriminator(x_fake.detach())
+    # Losses to train the discriminator
+    # 1. make sure the discriminator can tell real is real
+    real_loss = class_loss_fn(discriminator_x, y)
+    # 2. make sure the discriminator can't tell fake is fake
+    fake_loss = -class_loss_fn(discriminator_x_fake, y_target)
+    #
+    disc_loss = (real_loss + fake_loss) * 0.5
+    # Discriminator gradients
+    (disc_loss * loss_scale).backward()
+    return cycle_loss.detach(), adv_loss.detach(), disc_loss.detach()
+
+
+def warm_start(module, checkpoint):
+    """
+    Initialize `module` from the classifier weights in `checkpoint`. Only the
+    parameters with a matching name and shape are loaded, so a `DenseModel`
+    with a different number of outputs gets everything but its last layer.
+
+    Returns the names of the loaded parameters.
+    """
+    weights = torch.load(checkpoint, map_location="cpu", weights_only=True)
+    own = module.state_dict()
+    matching = {
+        key: value
+        for key, value in weights.items()
+        if key in own and own[key].shape == value.shape
+    }
+    module.load_state_dict(matching, strict=False)
+    return list(matching)
+
+
+class LayerFreezing:
+    """
+    Gradual unfreezing of a warm-started module. Its layers (the modules
+    holding parameters, from input to output) are frozen up to `num_frozen`
+    at epoch 0, and one more layer is unfrozen every `unfreeze_every` epochs
+    (never, if 0).
+
+    `train_step` toggles `requires_grad` on whole models, so frozen layers are
+    implemented by dropping their gradients before the optimizer step.
+    """
+
+    def __init__(self, module, num_frozen=0, unfreeze_every=1):
+        self.layers = [
+            layer
+            for layer in module.modules()
+            if any(True for _ in layer.parameters(recurse=False))
+        ]
+        self.num_frozen = num_frozen
+        self.unfreeze_every = unfreeze_every
+        self.frozen = self.layers[:num_frozen]
+
+    def set_epoch(self, epoch):
+        num_frozen = self.num_frozen
+        if self.unfreeze_every > 0:
+            num_frozen = max(0, num_frozen - epoch // self.unfreeze_every)
+        self.frozen = self.layers[:num_frozen]
+
+    def drop_frozen_gradients(self):
+        """Call before the optimizer step, Adam skips parameters without gradient"""
+        for layer in self.frozen:
+            for param in layer.parameters(recurse=False):
+                param.grad = None
+
+
+def enable_activation_checkpointing(unet):
+    """
+    Recompute the activations of the UNet's blocks during the backward pass
+    instead of keeping them in memory. The blocks are the entries of the UNet's
+    `ModuleList`s; their `forward` is wrapped in place, so the state dict keys
+    don't change.
+    """
+    for module in unet.modules():
+        if isinstance(module, nn.ModuleList):
+            for block in module:
+                block.forward = partial(
+                    torch.utils.checkpoint.checkpoint,
+                    block.forward,
+                    use_reentrant=False,
+                )
+
+
+def save_atomic(obj, path):
+    """
+    `torch.save` to a temporary file, then rename it to `path`, so that
+    readers such as `evaluate_checkpoints.py` never see a partial file.
+    """
+    path = Path(path)
+    tmp_path = path.with_suffix(".tmp")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def checkpoint_epoch(path):
+    """The epoch number of a `checkpoint_{epoch}.pth` file"""
+    return int(Path(path).stem.split("_")[-1])
+
+
+def train_gan(
+    save_dir="checkpoints/stargan",
+    data_dir="../data",
+    classifier_checkpoint="checkpoints/model.pth",
+    size_style=8,
+    depth=2,
+    lr_d=1e-6,
+    lr_g=1e-4,
+    ema_beta=0.999,
+    batch_size=32,
+    accumulation_steps=1,
+    activation_checkpointing=False,
+    total_epochs=14,
+    num_workers=None,
+    eval_every=500,
+    num_eval_images=256,
+    patience=5,
+    min_delta=1e-3,
+    target_flip_rate=None,
+    warm_start_discriminator=False,
+    warm_start_style=False,
+    num_frozen=0,
+    unfreeze_every=1,
+    autotune=True,
+):
+    """
+    Train the StarGAN, stopping early once the counterfactual flip rate of the
+    EMA generator on a held-out subset stops improving.
+
+    The flip rate is evaluated every `eval_every` steps with the frozen
+    classifier from `classifier_checkpoint`. The best EMA generator is stored
+    in `save_dir / "best.pth"`, and the flip rate history in
+    `save_dir / "flip_rate.json"`.
+
+    Each optimizer step accumulates the gradients of `accumulation_steps`
+    micro-batches of `batch_size` images (the last step of an epoch fewer, if
+    they don't divide the number of batches). With `activation_checkpointing`, the
+    UNet's activations are recomputed in the backward pass instead of stored.
+
+    With `warm_start_discriminator` and `warm_start_style`, the discriminator
+    and the style mapping (except its last layer) start from the classifier's
+    weights instead of a random initialization. Their first `num_frozen`
+    layers are frozen, and unfrozen one by one every `unfreeze_every` epochs.
+    Training stops once the flip rate reaches `target_flip_rate`, if given;
+    `flip_rate.json` records the wall-clock time of every evaluation.
+
+    On CPU, the thread settings are autotuned unless `autotune` is False,
+    e.g. when the caller already set them.
+
+    Returns the best flip rate.
+    """
+    save_dir = Path(save_dir)
     save_dir.mkdir(parents=True, exist_ok=True)
-    mnist = ColoredMNIST("../data", download=True, train=True)
+    mnist = ColoredMNIST(data_dir, download=True, train=True)
+    test_mnist = ColoredMNIST(data_dir, download=True, train=False)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    size_style = 8
-    total_epochs = 14
+    if device.type == "cpu" and autotune:
+        # The batch size is a training hyperparameter, only the threads are tuned
+        get_config("generator", depth=depth, size_style=size_style)
     unet = UNet(
-        depth=2,
+        depth=depth,
         in_channels=3 + size_style,
         out_channels=3,
         final_activation=nn.Sigmoid(),
     )
     discriminator = DenseModel(input_shape=(3, 28, 28), num_classes=4)
     style_mapping = DenseModel(input_shape=(3, 28, 28), num_classes=size_style)
+    freezing = []
+    if warm_start_discriminator:
+        warm_start(discriminator, classifier_checkpoint)
+        freezing.append(LayerFreezing(discriminator, num_frozen, unfreeze_every))
+    if warm_start_style:
+        warm_start(style_mapping, classifier_checkpoint)
+        freezing.append(LayerFreezing(style_mapping, num_frozen, unfreeze_every))
     generator = Generator(unet, style_mapping=style_mapping)
     generator_ema = Generator(deepcopy(unet), style_mapping=deepcopy(style_mapping))
 
+    if activation_checkpointing:
+        enable_activation_checkpointing(unet)
+
     # all models on the GPU
     generator = generator.to(device)
     generator_ema = generator_ema.to(device)
     discriminator = discriminator.to(device)
 
+    # Frozen classifier and fixed held-out images to measure the flip rate
+    classifier = load_classifier(classifier_checkpoint, device=device)
+    x_eval, y_eval = held_out_subset(test_mnist, num_images=num_eval_images)
+    x_eval, y_eval = x_eval.to(device), y_eval.to(device)
+    prototypes = class_prototypes(test_mnist).to(device)
+    early_stopping = EarlyStopping(patience=patience, min_delta=min_delta)
+
     cycle_loss_fn = nn.L1Loss()
     class_loss_fn = nn.CrossEntropyLoss()
 
-    optimizer_d = torch.optim.Adam(discriminator.parameters(), lr=1e-6)
-    optimizer_g = torch.optim.Adam(generator.parameters(), lr=1e-4)
+    optimizer_d = torch.optim.Adam(discriminator.parameters(), lr=lr_d)
+    optimizer_g = torch.optim.Adam(generator.parameters(), lr=lr_g)
 
-    dataloader = DataLoader(
-        mnist, batch_size=32, drop_last=True, shuffle=True
+    dataloader = make_dataloader(
+        mnist,
+        batch_size=batch_size,
+        drop_last=True,
+        shuffle=True,
+        device=device,
+        num_workers=num_workers,
     )  # We will use the same dataset as before
 
     # Load last existing checkpoint
     epoch = 0
-    checkpoints = sorted(save_dir.glob("checkpoint_*.pth"))
+    step = 0
+    flip_rates = []
+    checkpoints = sorted(save_dir.glob("checkpoint_*.pth"), key=checkpoint_epoch)
     if len(checkpoints) > 0:
         checkpoint = torch.load(checkpoints[-1])
         print(f"Resuming from checkpoint {checkpoints[-1]}")
@@ -95,71 +374,95 @@ if __name__ == "__main__":
         style_mapping.load_state_dict(checkpoint["style_mapping"])
         optimizer_g.load_state_dict(checkpoint["optimizer_g"])
         optimizer_d.load_state_dict(checkpoint["optimizer_d"])
+        # The generator holds the EMA parameters at the end of each epoch
+        copy_parameters(generator, generator_ema)
+        if "early_stopping" in checkpoint:
+            early_stopping.load_state_dict(checkpoint["early_stopping"])
+            step = checkpoint["step"]
+        if (save_dir / "flip_rate.json").exists():
+            with open(save_dir / "flip_rate.json", "r") as f:
+                flip_rates = json.load(f)
         epoch = (
             checkpoint["epoch"] + 1
         )  # Start from the next epoch since this checkpoint exists
 
     losses = {"cycle": [], "adv": [], "disc": []}
+    start_time = time.perf_counter()
+    target_reached = False
     for epoch in range(epoch, total_epochs):
-        for x, y in tqdm(dataloader, desc=f"Epoch {epoch}"):
-            x = x.to(device)
-            y = y.to(device)
-            # get the target y by shuffling the classes
-            # get the style sources by random sampling
-            random_index = torch.randperm(len(y))
-            x_style = x[random_index].clone()
-            y_target = y[random_index].clone()
-
-            # Set training gradients correctly
-            set_requires_grad(generator, True)
-            set_requires_grad(discriminator, False)
-            optimizer_g.zero_grad()
-            # Get the fake image
-            x_fake = generator(x, x_style)
-            # Try to cycle back
-            x_cycled = generator(x_fake, x)
-            # Discriminate
-            discriminator_x_fake = discriminator(x_fake)
-            # Losses to  train the generator
-
-            # 1. make sure the image can be reconstructed
-            cycle_loss = cycle_loss_fn(x, x_cycled)
-            # 2. make sure the discriminator is fooled
-            adv_loss = class_loss_fn(discriminator_x_fake, y_target)
-
-            # Optimize the generator
-            (cycle_loss + adv_loss).backward()
+        if early_stopping.should_stop or target_reached:
+            break
+        for layers in freezing:
+            layers.set_epoch(epoch)
+        for i, (x, y) in enumerate(
+            tqdm(prefetch(dataloader, device), desc=f"Epoch {epoch}")
+        ):
+            if i % accumulation_steps == 0:
+                optimizer_g.zero_grad()
+                optimizer_d.zero_grad()
+                accumulated = torch.zeros(3, device=device)
+                # The last group of the epoch may have fewer micro-batches
+                group_size = min(accumulation_steps, len(dataloader) - i)
+            cycle_loss, adv_loss, disc_loss = train_step(
+                generator,
+                discriminator,
+                x,
+                y,
+                cycle_loss_fn,
+                class_loss_fn,
+                loss_scale=1 / group_size,
+            )
+            accumulated += torch.stack([cycle_loss, adv_loss, disc_loss])
+            if i % accumulation_steps + 1 < group_size:
+                continue
+            # Optimize both networks once all micro-batches are accumulated
+            for layers in freezing:
+                layers.drop_frozen_gradients()
             optimizer_g.step()
-
-            # Set training gradients correctly
-            set_requires_grad(generator, False)
-            set_requires_grad(discriminator, True)
-            optimizer_d.zero_grad()
-            # Discriminate
-            discriminator_x = discriminator(x)
-            discriminator_x_fake = discriminator(x_fake.detach())
-            # Losses to train the discriminator
-            # 1. make sure the discriminator can tell real is real
-            real_loss = class_loss_fn(discriminator_x, y)
-            # 2. make sure the discriminator can't tell fake is fake
-            fake_loss = -class_loss_fn(discriminator_x_fake, y_target)
-            #
-            disc_loss = (real_loss + fake_loss) * 0.5
-            disc_loss.backward()
-            # Optimize the discriminator
             optimizer_d.step()
 
+            cycle_loss, adv_loss, disc_loss = accumulated / group_size
             losses["cycle"].append(cycle_loss.item())
             losses["adv"].append(adv_loss.item())
             losses["disc"].append(disc_loss.item())
 
             # EMA update
-            exponential_moving_average(generator, generator_ema)
-            # TODO add logging, add checkpointing
+            exponential_moving_average(generator, generator_ema, beta=ema_beta)
+            step += 1
+
+            # Validation
+            if step % eval_every == 0:
+                rate = flip_rate(generator_ema, classifier, x_eval, y_eval, prototypes)
+                flip_rates.append(
+                    {
+                        "step": step,
+                        "epoch": epoch,
+                        "flip_rate": rate,
+                        "seconds": time.perf_counter() - start_time,
+                    }
+                )
+                if early_stopping.step(rate):
+                    save_atomic(
+                        {
+                            "unet": generator_ema.generator.state_dict(),
+                            "style_mapping": generator_ema.style_mapping.state_dict(),
+                            "epoch": epoch,
+                            "step": step,
+                            "flip_rate": rate,
+                        },
+                        save_dir / "best.pth",
+                    )
+                if early_stopping.should_stop:
+                    print(f"Flip rate plateaued at {early_stopping.best:.3f}, stopping")
+                    break
+                if target_flip_rate is not None and rate >= target_flip_rate:
+                    print(f"Flip rate reached {rate:.3f}, stopping")
+                    target_reached = True
+                    break
         # Copy the EMA model's parameters to the generator
         copy_parameters(generator_ema, generator)
         # Store checkpoint
-        torch.save(
+        save_atomic(
             {
                 "unet": unet.state_dict(),
                 "discriminator": discriminator.state_dict(),
@@ -167,9 +470,18 @@ if __name__ == "__main__":
                 "optimizer_g": optimizer_g.state_dict(),
                 "optimizer_d": optimizer_d.state_dict(),
                 "epoch": epoch,
+                "step": step,
+                "early_stopping": early_stopping.state_dict(),
             },
             save_dir / f"checkpoint_{epoch}.pth",
         )
         # Store losses
         with open(save_dir / "losses.json", "w") as f:
             json.dump(losses, f)
+        with open(save_dir / "flip_rate.json", "w") as f:
+            json.dump(flip_rates, f)
+    return early_stopping.best
+
+
+if __name__ == "__main__":
+    train_gan()
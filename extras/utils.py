@@ -0,0 +1,36 @@
+"""
+Small helpers shared across the scripts: content hashes of checkpoints for
+cache keys, loading a ColoredMNIST split, and the cores this process may use.
+None of them imports torch at module level.
+"""
+
+import hashlib
+import os
+
+_file_hashes = {}
+
+
+def file_hash(path):
+    """Content hash of the file at `path`, memoized on its size and mtime"""
+    stat = os.stat(path)
+    memo_key = (str(path), stat.st_size, stat.st_mtime)
+    if memo_key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _file_hashes[memo_key] = h.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def load_split(data_dir, split, download=True):
+    from classifier.data import ColoredMNIST
+
+    return ColoredMNIST(data_dir, download=download, train=split == "train")
+
+
+def available_cores():
+    """The cores this process may run on, in ascending order"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
@@ -2,12 +2,9 @@
 This script was used to validate the pre-trained classifier.
 """
 
-from classifier.model import DenseModel
-from classifier.data import ColoredMNIST
 import numpy as np
+from logit_cache import LogitCache
 import torch
-from torch.utils.data import DataLoader
-from tqdm import tqdm
 
 
 def confusion_matrix(labels, predictions):
@@ -19,26 +16,20 @@ def confusion_matrix(labels, predictions):
 
 
 def validate_classifier(checkpoint_dir):
-    data = ColoredMNIST("../data", download=False, train=False)
-    dataloader = DataLoader(
-        data, batch_size=32, shuffle=False, pin_memory=True, drop_last=False
-    )
-
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = DenseModel((28, 28, 3), 4)
-    model.to(device)
-    model.load_state_dict(torch.load(f"{checkpoint_dir}/model.pth", weights_only=True))
-
-    labels = []
-    predictions = []
-    for x, y in tqdm(dataloader, desc=f"Validation"):
-        pred = model(x.to(device))
-        pred_y = torch.argmax(pred, dim=1)
-        labels.extend(y.numpy())
-        predictions.extend(pred_y.cpu().numpy())
+    # Only the first validation of a checkpoint runs the model, and only then
+    # is the batch size tuned on CPU
+    cache = LogitCache(
+        f"{checkpoint_dir}/model.pth",
+        split="test",
+        data_dir="../data",
+        device=device,
+        batch_size=None if device.type == "cpu" else 32,
+        download=False,
+    )
 
     # Get confusion matrix
-    matrix = confusion_matrix(labels, predictions)
+    matrix = confusion_matrix(cache.labels, cache.predictions())
     # Save matrix as text
     np.savetxt(f"{checkpoint_dir}/confusion_matrix.txt", matrix, fmt="%d")
 